@@ -1,10 +1,16 @@
+import os
 import streamlit as st
 import database
 import processor
+import instrumentation
+import jobs
 from streamlit_agraph import agraph, Node, Edge, Config
 
 st.set_page_config(layout="wide", page_title="Document Auditor")
 
+# Above this many documents the graph opens in focused (k-hop) mode
+FOCUS_THRESHOLD = 200
+
 # Custom CSS to reduce whitespace and title size
 st.markdown("""
 <style>
@@ -55,6 +61,123 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+@st.cache_data(show_spinner=False)
+def build_graph(generation, show_ghosts, root_doc_id=None, depth=2, group_ghosts=False):
+    """
+    Builds the graph nodes and edges. Memoized on the DB generation counter, so reruns
+    (e.g. toggling the animation) reuse them until a scan changes documents or dependencies.
+    With root_doc_id only its depth-hop neighborhood is built; with group_ghosts the
+    unresolved references are collapsed into one node per citation type.
+    """
+    doc_names, dependencies = database.get_dependencies_graph(root_doc_id, depth)
+
+    nodes = []
+    edges = []
+    added_node_ids = set()
+    ghost_groups = {}  # citation type -> (node id, number of distinct references)
+    grouped_edges = set()
+    
+    # Add Nodes
+    for filename in doc_names:
+        nodes.append(Node(id=filename, label=filename, size=25, shape="dot"))
+        added_node_ids.add(filename)
+        
+    # Add Edges (names already joined in SQL)
+    for child_name, parent_name, ref_name, citation_type in dependencies:
+        if parent_name:
+            edges.append(Edge(source=child_name, target=parent_name, label="depende de"))
+        elif show_ghosts and group_ghosts:
+            # One aggregate node per citation type (e.g. all the missing laws)
+            group_id = f"__ghost_{citation_type}"
+            if group_id not in ghost_groups:
+                ghost_groups[group_id] = (citation_type, set())
+            ghost_groups[group_id][1].add(ref_name)
+            if (child_name, group_id) not in grouped_edges:
+                grouped_edges.add((child_name, group_id))
+                edges.append(Edge(source=child_name, target=group_id, label="refiere a"))
+        elif show_ghosts:
+            # Create a ghost node for the unresolved reference
+            # Check duplication first
+            if ref_name not in added_node_ids:
+                nodes.append(Node(id=ref_name, label=ref_name + " (?)", color="gray"))
+                added_node_ids.add(ref_name)
+                
+            edges.append(Edge(source=child_name, target=ref_name, label="refiere a"))
+
+    for group_id, (citation_type, refs) in ghost_groups.items():
+        type_name = processor.CITATION_PREFIXES[citation_type][0] if citation_type in processor.CITATION_PREFIXES else "Otros"
+        nodes.append(Node(id=group_id, label=f"{type_name}: {len(refs)} no disponibles (?)", color="gray", size=15 + min(len(refs), 30)))
+
+    return nodes, edges
+
+def render_scan_status(was_running):
+    """Scan button, or the progress of the running scan (shared by every session) with a cancel button"""
+    job = jobs.get_scan_progress()
+    if job and job["status"] == "running":
+        done, total = job["files_done"], job["files_total"] or 0
+        st.progress(done / total if total else 0.0,
+                    text=f"Escaneando {done}/{total}: {job['current_file'] or 'buscando cambios...'}")
+        eta = f", quedan ~{job['eta']:.0f} s" if job["eta"] is not None else ""
+        st.caption(f"{job['files_per_second']:.1f} archivos/s, {job['bytes_per_second'] / 1e6:.1f} MB/s{eta}")
+        if st.button("⏹️ Cancelar escaneo", disabled=bool(job["cancel_requested"])):
+            jobs.cancel_scan(job["id"])
+        return
+
+    if was_running:
+        # The scan just finished: redraw the whole page with the new documents
+        st.rerun()
+
+    if st.button("🔄 Escanear Documentos"):
+        if jobs.start_scan(workers=os.cpu_count(), profile=st.session_state.get('profile_scans', False)) is None:
+            st.warning("Ya hay un escaneo en curso.")
+        else:
+            st.rerun()
+
+    if job and job["stats"]:
+        stats = job["stats"]
+        outcome = "cancelado" if job["status"] == "cancelled" else "completado"
+        st.caption(
+            f"Último escaneo ({outcome}): {stats['added']} nuevos, {stats['updated']} actualizados, "
+            f"{stats['skipped']} sin cambios, {stats['removed']} eliminados, en {job['elapsed']:.1f} s"
+        )
+    elif job and job["status"] == "failed":
+        st.error(f"El último escaneo falló: {job['error']}")
+
+def render_performance_panel():
+    """Collapsible sidebar panel with the hot-path timings and the cProfile dump of the last scan"""
+    with st.sidebar.expander("⏱️ Rendimiento", expanded=False):
+        enabled = st.checkbox("Medir tiempos (base de datos y análisis)", value=instrumentation.ENABLED)
+        instrumentation.enable(enabled)
+        st.checkbox("Perfilar escaneos con cProfile", key="profile_scans",
+                    help="Los workers del escaneo en paralelo no se perfilan; solo el proceso principal.")
+
+        stats = instrumentation.get_stats()
+        if stats:
+            st.dataframe([
+                {"Función": name, "Llamadas": calls, "Total (ms)": round(seconds * 1000, 1),
+                 "p95 (ms)": round(p95 * 1000, 2), "Filas": rows}
+                for name, calls, seconds, p95, rows in stats
+            ], hide_index=True)
+            if st.button("Reiniciar mediciones"):
+                instrumentation.reset()
+                st.rerun()
+        elif enabled:
+            st.caption("Sin mediciones todavía: usa la aplicación y vuelve aquí.")
+
+        job = jobs.get_scan_progress()
+        profile = jobs.SCAN_PROFILES.get(job["id"]) if job else None
+        if profile:
+            dump, summary = profile
+            st.download_button("Descargar perfil del último escaneo (.prof)", dump,
+                               file_name="scan.prof", mime="application/octet-stream")
+            if st.checkbox("Ver resumen del perfil"):
+                st.text(summary)
+
+def render_audit_cache_stats(placeholder):
+    """Writes the audit cache hit/miss counts into a sidebar placeholder"""
+    cache_stats = processor.AUDIT_CACHE_STATS
+    placeholder.caption(f"Caché de auditoría: {cache_stats['hits']} aciertos, {cache_stats['misses']} fallos")
+
 def main():
     st.sidebar.title("Doc Auditor")
     
@@ -62,11 +185,25 @@ def main():
     database.init_db()
 
     # --- SIDEBAR ACTIONS ---
-    if st.sidebar.button("🔄 Escanear Documentos"):
-        with st.spinner("Procesando documentos..."):
-            processor.scan_directory()
-        st.success("Escaneo completado!")
-        st.rerun()
+    # Scans run in the background (see jobs.py); the panel polls their progress while one runs
+    job = jobs.get_scan_progress()
+    running = job is not None and job["status"] == "running"
+    with st.sidebar:
+        st.fragment(render_scan_status, run_every=1.0 if running else None)(running)
+
+    # Audit cache counts, filled in at the end of the run so they include this run's audit
+    cache_caption = st.sidebar.empty()
+
+    # Full-text search over the sections of every document (FTS5, BM25 ranking)
+    search_text = st.sidebar.text_input("🔎 Buscar en el corpus")
+    if search_text:
+        results = processor.search(search_text)
+        if not results:
+            st.sidebar.caption("Sin resultados.")
+        for doc_id, filename, position, title, start, end, snippet, score in results:
+            st.sidebar.markdown(f"**{filename}** · {title}\n\n{snippet}")
+
+    render_performance_panel()
 
     view_mode = st.sidebar.radio("Vista", ["Arbol de Dependencias", "Lectura Inteligente / Auditoría"])
 
@@ -75,38 +212,26 @@ def main():
         st.markdown('<div class="sticky-header">Arbol de Dependencias</div>', unsafe_allow_html=True)
         
         show_ghosts = st.sidebar.checkbox("Mostrar documentos no disponibles", value=True)
+        group_ghosts = st.sidebar.checkbox("Agrupar no disponibles por tipo", value=False, disabled=not show_ghosts)
 
-        docs, dependencies = database.get_dependencies_graph()
+        # Focused mode: only the neighborhood of one document (on by default for large corpora)
+        all_docs = database.get_all_docs()
+        root_doc_id = None
+        depth = 2
+        if st.sidebar.checkbox("Vista enfocada (vecindario de un documento)", value=len(all_docs) > FOCUS_THRESHOLD):
+            doc_options = {d[1]: d[0] for d in all_docs}
+            root_filename = st.sidebar.selectbox("Documento raíz", list(doc_options.keys()))
+            depth = st.sidebar.slider("Profundidad (saltos)", 1, 5, 2)
+            if root_filename:
+                root_doc_id = doc_options[root_filename]
+
+        nodes, edges = build_graph(database.get_generation(), show_ghosts, root_doc_id, depth, group_ghosts)
         
-        if not docs:
+        if not nodes:
             st.warning("No hay documentos en la base de datos. Por favor pon archivos .txt en la carpeta 'documentos' y dale a 'Escanear'.")
+            render_audit_cache_stats(cache_caption)
             return
 
-        nodes = []
-        edges = []
-        added_node_ids = set()
-        
-        # Add Nodes
-        for doc_id, filename in docs:
-            nodes.append(Node(id=filename, label=filename, size=25, shape="dot"))
-            added_node_ids.add(filename)
-            
-        # Add Edges
-        for child_id, parent_id, ref_name in dependencies:
-            child_name = next((d[1] for d in docs if d[0] == child_id), "Unknown")
-            
-            if parent_id:
-                parent_name = next((d[1] for d in docs if d[0] == parent_id), "Unknown")
-                edges.append(Edge(source=child_name, target=parent_name, label="depende de"))
-            elif show_ghosts:
-                # Create a ghost node for the unresolved reference
-                # Check duplication first
-                if ref_name not in added_node_ids:
-                    nodes.append(Node(id=ref_name, label=ref_name + " (?)", color="gray"))
-                    added_node_ids.add(ref_name)
-                    
-                edges.append(Edge(source=child_name, target=ref_name, label="refiere a"))
-
         # Physics / Animation Toggle
         # If checked: Stabilization False (Show animation)
         # If unchecked: Stabilization True (Show static / pre-calculated)
@@ -159,53 +284,52 @@ def main():
         
         if selected_filename:
             doc_id = doc_options[selected_filename]
-            doc_data = database.get_doc_by_id(doc_id) # id, filename, content
-            child_content = doc_data[2]
-            
             col1, col2 = st.columns([1, 1])
             
             with col1:
                 st.subheader("📄 Contenido y Análisis")
                 
-                # Analyze structure
-                struct = processor.analyze_document_structure(child_content)
+                # Structure and summaries are precomputed at scan time
+                general_summary, sections = processor.get_document_structure(doc_id)
                 
                 st.markdown("### Resumen General")
-                st.info(struct["general_summary"] or "No se pudo generar un resumen.")
+                st.info(general_summary or "No se pudo generar un resumen.")
                 
                 st.markdown("### Secciones Detectadas")
-                for i, section in enumerate(struct["sections"]):
-                    with st.expander(f"{section['title']} ({len(section['content'])} chars)"):
+                for position, title, start, end, summary in sections:
+                    with st.expander(f"{title} ({end - start} chars)"):
                         st.markdown("**Resumen de la sección:**")
-                        st.markdown(f"_{section['summary']}_")
-                        st.markdown("**Contenido:**")
-                        st.text_area("Texto", section['content'], height=200, key=f"{section['title']}_{doc_id}_{i}")
+                        st.markdown(f"_{summary}_")
+                        # The body is only loaded from the DB when requested
+                        if st.checkbox("Mostrar contenido", key=f"show_{doc_id}_{position}"):
+                            st.text_area("Texto", database.get_section_content(doc_id, position), height=200, key=f"{title}_{doc_id}_{position}")
                 
             with col2:
                 st.subheader("🛡️ Reporte de Auditoría")
                 
-                # Get Parents
-                parents = database.get_parent_docs(doc_id)
+                # Get Parents (optionally every ancestor: the law a regulating decree implements also applies)
+                direct_parents = database.get_parent_docs(doc_id)
+                include_ancestors = st.checkbox("Incluir normas heredadas (ancestros de los rectores)", value=False)
+                parents = database.get_ancestor_docs(doc_id) if include_ancestors else direct_parents
+                direct_ids = {p_id for p_id, _ in direct_parents}
                 
                 if not parents:
                     st.info("Este documento no parece depender de otros (o no se encontraron referencias).")
                 
-                for p_id, p_filename in parents:
+                # Check the rules of every parent (cached until either document changes)
+                report = processor.audit_against_parents(doc_id, parents)
+                
+                for p_id, p_filename, rules in report:
                     st.write(f"---")
-                    st.subheader(f"Rector: {p_filename}")
+                    st.subheader(f"Rector: {p_filename}" if p_id in direct_ids else f"Rector heredado: {p_filename}")
                     
                     # Check connection
                     st.success("✅ Documento Rector encontrado en sistema.")
                     
-                    # Get Rules from Parent
-                    rules = database.get_rules_for_doc(p_id)
                     if not rules:
                         st.warning("⚠️ No se extrajeron reglas claras de este documento rector.")
                     
-                    for rule_text, rule_type in rules:
-                        # AUDIT CHECK
-                        status = processor.check_compliance(child_content, rule_text)
-                        
+                    for i, (rule_text, rule_type, status, evidence) in enumerate(rules):
                         icon = "⚪"
                         color = "gray"
                         msg = "Desconocido"
@@ -226,5 +350,13 @@ def main():
                         st.markdown(f"**[{rule_type}]** {rule_text}")
                         st.markdown(f":{color}[{icon} **{msg}**]")
 
+                        # Best-matching passage of this document, read from its offsets
+                        if evidence and status in ("MATCH", "PARTIAL"):
+                            start, end = evidence
+                            if st.checkbox(f"Ver evidencia (caracteres {start}–{end})", key=f"ev_{doc_id}_{p_id}_{i}"):
+                                st.text(database.get_content_range(doc_id, start, end))
+
+    render_audit_cache_stats(cache_caption)
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,167 @@
+"""
+Per-stage timings of the whole pipeline on a synthetic corpus (see corpus.py), as JSON.
+
+Usage:
+    python benchmarks/bench_pipeline.py [--docs N] [--seed S] [--repeats R] [--workers W]
+                                        [--output FILE] [--baseline FILE] [--threshold 0.25]
+    python benchmarks/bench_pipeline.py --compare OLD.json NEW.json [--threshold 0.25]
+
+Each repeat builds the corpus in a temporary directory and runs, in order: a cold
+scan_directory, a scan with nothing changed, extract_dependencies_from_text,
+resolve_dependencies, extract_rules_from_text, analyze_document_structure and
+check_compliance (every child against the rules of its parents), plus the indexed
+match_rules_in_document. The best time of each stage over the repeats is reported.
+With --baseline (or --compare) the stages that got slower than the threshold are
+flagged and the script exits with status 1.
+"""
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import database
+import processor
+from corpus import generate_corpus, load_templates
+
+# Stages shorter than this are too noisy to flag as regressions
+MIN_FLAGGED_SECONDS = 0.005
+
+def _stage(results, name, func, items):
+    start = time.perf_counter()
+    func()
+    results[name] = {"seconds": time.perf_counter() - start, "items": items}
+
+def run_once(n_docs, seed, workers, templates):
+    """Builds a corpus in a fresh directory and times every stage. Returns {stage: {"seconds", "items"}}"""
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        docs_dir = os.path.join(tmp, "documentos")
+        generate_corpus(docs_dir, n_docs, seed=seed, templates=templates)
+        database.DB_PATH = os.path.join(tmp, "bench.db")
+        database.init_db()
+        docs_dir_before = processor.DOCS_DIR
+        processor.DOCS_DIR = docs_dir
+        try:
+            _stage(results, "scan_directory", lambda: processor.scan_directory(workers=workers), n_docs)
+            _stage(results, "scan_directory_unchanged", lambda: processor.scan_directory(workers=workers), n_docs)
+
+            docs = [(doc_id, database.get_doc_content(doc_id)) for doc_id, _ in database.get_all_docs()]
+            n_chars = sum(len(text) for _, text in docs)
+
+            def extract_dependencies():
+                for doc_id, text in docs:
+                    processor.extract_dependencies_from_text(doc_id, text)
+            _stage(results, "extract_dependencies_from_text", extract_dependencies, len(docs))
+            n_deps = database.get_connection().execute("SELECT COUNT(*) FROM dependencies").fetchone()[0]
+            _stage(results, "resolve_dependencies", database.resolve_dependencies, n_deps)
+
+            def extract_rules():
+                for doc_id, text in docs:
+                    processor.extract_rules_from_text(doc_id, text)
+            _stage(results, "extract_rules_from_text", extract_rules, len(docs))
+
+            def analyze_structure():
+                for _, text in docs:
+                    processor.analyze_document_structure(text)
+            _stage(results, "analyze_document_structure", analyze_structure, len(docs))
+
+            # Every child against the rules of each of its parents
+            pairs = []
+            for doc_id, text in docs:
+                for parent_id, _ in database.get_parent_docs(doc_id):
+                    pairs.append((doc_id, text, [rule for rule, _ in database.get_rules_for_doc(parent_id)]))
+            n_rules = sum(len(rules) for _, _, rules in pairs)
+
+            def check_compliance():
+                for _, text, rules in pairs:
+                    processor.check_compliance_batch(text, rules)
+            _stage(results, "check_compliance", check_compliance, n_rules)
+
+            def match_rules_in_document():
+                for doc_id, _, rules in pairs:
+                    processor.match_rules_in_document(doc_id, rules)
+            _stage(results, "match_rules_in_document", match_rules_in_document, n_rules)
+        finally:
+            processor.DOCS_DIR = docs_dir_before
+            database.close_connection()
+    return results, {"chars": n_chars, "dependencies": n_deps, "rule_checks": n_rules}
+
+def run(n_docs, seed, repeats, workers):
+    templates = load_templates()
+    best = {}
+    corpus = {}
+    for _ in range(repeats):
+        results, corpus = run_once(n_docs, seed, workers, templates)
+        for name, result in results.items():
+            if name not in best or result["seconds"] < best[name]["seconds"]:
+                best[name] = result
+    for result in best.values():
+        result["ms_per_item"] = result["seconds"] * 1000 / max(result["items"], 1)
+    return {
+        "meta": {
+            "docs": n_docs, "seed": seed, "repeats": repeats, "workers": workers, "corpus": corpus,
+            "python": platform.python_version(), "sqlite": sqlite3.sqlite_version,
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "stages": best,
+    }
+
+def print_report(report):
+    meta = report["meta"]
+    print(f"{meta['docs']} docs, {meta['corpus']['chars']} chars, seed {meta['seed']}, best of {meta['repeats']}")
+    print(f"{'stage':<32} {'seconds':>9} {'items':>8} {'ms/item':>9}")
+    for name, result in report["stages"].items():
+        print(f"{name:<32} {result['seconds']:>9.3f} {result['items']:>8} {result['ms_per_item']:>9.3f}")
+
+def compare(old, new, threshold):
+    """Prints old vs new time per stage; returns the names of the stages that regressed"""
+    regressions = []
+    print(f"{'stage':<32} {'old s':>9} {'new s':>9} {'change':>8}")
+    for name, result in new["stages"].items():
+        if name not in old["stages"]:
+            continue
+        before, after = old["stages"][name]["seconds"], result["seconds"]
+        change = (after - before) / before if before else 0.0
+        regressed = change > threshold and after - before > MIN_FLAGGED_SECONDS
+        if regressed:
+            regressions.append(name)
+        print(f"{name:<32} {before:>9.3f} {after:>9.3f} {change:>+8.0%}{'  REGRESSION' if regressed else ''}")
+    if old["meta"]["docs"] != new["meta"]["docs"] or old["meta"]["seed"] != new["meta"]["seed"]:
+        print("Warning: the runs used different corpora (docs/seed); the comparison is not meaningful.")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--docs", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=1, help="scan_directory workers")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare the results with this earlier JSON file")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="only compare two JSON files")
+    parser.add_argument("--threshold", type=float, default=0.25, help="slowdown flagged as regression (0.25 = 25%%)")
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f_old, open(args.compare[1]) as f_new:
+            return 1 if compare(json.load(f_old), json.load(f_new), args.threshold) else 0
+
+    report = run(args.docs, args.seed, args.repeats, args.workers)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print()
+        return 1 if compare(baseline, report, args.threshold) else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
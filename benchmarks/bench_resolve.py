@@ -0,0 +1,66 @@
+"""
+Benchmark for database.resolve_dependencies on synthetic corpora of growing size.
+
+Usage: python benchmarks/bench_resolve.py [sizes...]   (default: 10 100 1000 10000 100000)
+
+Each document is a law identified by its citation key. The first 1% are base laws
+citing nothing; every other law cites 5 base laws (20% of them missing from the
+corpus), so the ancestors closure refreshed by resolve_dependencies stays the size
+of the dependency list. Time per dependency should stay flat, and so should the time of
+an incremental resolve_dependencies for one touched document (as in watch mode).
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import database
+
+CITES_PER_DOC = 5
+
+def build_corpus(n_docs):
+    rng = random.Random(n_docs)
+    with database.transaction() as conn:
+        conn.executemany("INSERT INTO docs (id, filename, content) VALUES (?, ?, '')",
+                         [(i, f"LEY_PERU_{10000 + i}_2020_sintetica.txt") for i in range(1, n_docs + 1)])
+        conn.executemany("INSERT INTO doc_numbers (number, doc_id) VALUES (?, ?)",
+                         [(str(10000 + i), i) for i in range(1, n_docs + 1)])
+        conn.executemany("INSERT INTO doc_keys (citation_key, doc_id) VALUES (?, ?)",
+                         [(f"LEY-{10000 + i}", i) for i in range(1, n_docs + 1)])
+        deps = []
+        n_base = max(1, n_docs // 100)
+        for child in range(n_base + 1, n_docs + 1):
+            for _ in range(CITES_PER_DOC):
+                # 20% of the citations point to laws that are not in the corpus
+                number = 10000 + rng.randint(1, n_base) if rng.random() < 0.8 else 900000 + rng.randint(1, n_docs)
+                deps.append((child, f"Ley N° {number}", f"LEY-{number}", "LEY", str(number)))
+        # A law cited twice by the same document is one dependency (as in replace_dependencies)
+        c = conn.executemany("""INSERT OR IGNORE INTO dependencies (child_doc_id, parent_ref_name, citation_key, citation_type,
+                                                                citation_number)
+                                VALUES (?, ?, ?, ?, ?)""", deps)
+    return c.rowcount
+
+def run(n_docs):
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_PATH = os.path.join(tmp, "bench.db")
+        database.init_db()
+        n_deps = build_corpus(n_docs)
+        start = time.perf_counter()
+        database.resolve_dependencies()
+        elapsed = time.perf_counter() - start
+        resolved = database.get_connection().execute(
+            "SELECT COUNT(*) FROM dependencies WHERE parent_doc_id IS NOT NULL").fetchone()[0]
+        # One base law touched, as a watch batch would: its dependents are found through the indexes
+        start = time.perf_counter()
+        database.resolve_dependencies([1])
+        touched = time.perf_counter() - start
+        database.close_connection()
+    print(f"{n_docs:>7} docs  {n_deps:>7} deps  {resolved:>7} resolved  "
+          f"{elapsed * 1000:9.1f} ms  {elapsed / n_deps * 1e6:6.2f} us/dep  {touched * 1000:7.2f} ms for 1 touched")
+
+if __name__ == "__main__":
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10, 100, 1000, 10000, 100000]
+    for size in sizes:
+        run(size)
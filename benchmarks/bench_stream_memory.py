@@ -0,0 +1,68 @@
+"""
+Peak memory of the streaming ingest path (processor._ingest_streaming) for growing file sizes.
+
+Usage: python benchmarks/bench_stream_memory.py [sizes in MB...]   (default: 4 16)
+
+Builds one large file per size by repeating the bundled documentos/ texts, scans it
+with streaming forced on and reports the tracemalloc peak. The peak must not grow with
+the file size; the script exits with an error if it grows by more than MAX_GROWTH_PER_MB
+per MB of file between the smallest and the largest size.
+"""
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import database
+import processor
+
+# Peak memory growth tolerated per MB of file (anything held per line, rule or section shows up here)
+MAX_GROWTH_PER_MB = 0.05
+
+def build_file(path, size_mb):
+    corpus = []
+    for filename in sorted(os.listdir(processor.DOCS_DIR)):
+        if filename.endswith(".txt"):
+            with open(os.path.join(processor.DOCS_DIR, filename), "r", encoding="utf-8", errors="ignore") as f:
+                corpus.append(f.read())
+    corpus = "\n".join(corpus)
+    written = 0
+    with open(path, "w", encoding="utf-8") as f:
+        while written < size_mb * 1024 * 1024:
+            f.write(corpus)
+            written += len(corpus.encode("utf-8"))
+
+def run(size_mb):
+    with tempfile.TemporaryDirectory() as tmp:
+        docs_dir = os.path.join(tmp, "documentos")
+        os.makedirs(docs_dir)
+        build_file(os.path.join(docs_dir, "CONSOLIDADO_grande.txt"), size_mb)
+
+        database.DB_PATH = os.path.join(tmp, "bench.db")
+        database.init_db()
+        docs_dir_before, threshold_before = processor.DOCS_DIR, processor.STREAM_THRESHOLD_BYTES
+        processor.DOCS_DIR, processor.STREAM_THRESHOLD_BYTES = docs_dir, 0
+        try:
+            tracemalloc.start()
+            start = time.perf_counter()
+            processor.scan_directory()
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        finally:
+            processor.DOCS_DIR, processor.STREAM_THRESHOLD_BYTES = docs_dir_before, threshold_before
+            database.close_connection()
+    print(f"{size_mb:>6} MB file  peak {peak / 1024 / 1024:8.1f} MB  {elapsed:7.1f} s")
+    return peak
+
+if __name__ == "__main__":
+    sizes = [int(arg) for arg in sys.argv[1:]] or [4, 16]
+    peaks = dict(zip(sizes, [run(size) for size in sizes]))
+    smallest, largest = min(sizes), max(sizes)
+    if largest > smallest:
+        growth = (peaks[largest] - peaks[smallest]) / (largest - smallest) / 1024 / 1024
+        print(f"growth {growth:.3f} MB per MB of file")
+        if growth > MAX_GROWTH_PER_MB:
+            sys.exit("Peak memory grows with file size")
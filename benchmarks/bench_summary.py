@@ -0,0 +1,30 @@
+"""
+Micro-benchmark for processor.generate_summary and analyze_document_structure
+on the bundled documentos/ corpus.
+
+Usage: python benchmarks/bench_summary.py [repeats]   (default: 5, best time is reported)
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import processor
+
+def run(repeats):
+    total_summary = total_structure = 0.0
+    print(f"{'document':<52} {'chars':>8} {'summary ms':>11} {'structure ms':>13}")
+    for filename in sorted(os.listdir(processor.DOCS_DIR)):
+        if not filename.endswith(".txt"):
+            continue
+        with open(os.path.join(processor.DOCS_DIR, filename), "r", encoding="utf-8", errors="ignore") as f:
+            text = f.read()
+        summary = min(timeit.repeat(lambda: processor.generate_summary(text), number=1, repeat=repeats))
+        structure = min(timeit.repeat(lambda: processor.analyze_document_structure(text), number=1, repeat=repeats))
+        total_summary += summary
+        total_structure += structure
+        print(f"{filename:<52} {len(text):>8} {summary * 1000:>11.2f} {structure * 1000:>13.2f}")
+    print(f"{'TOTAL':<52} {'':>8} {total_summary * 1000:>11.2f} {total_structure * 1000:>13.2f}")
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
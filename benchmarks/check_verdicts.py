@@ -0,0 +1,81 @@
+"""
+Checks that both compliance paths give the same verdicts: check_compliance_batch (a text not
+in the database) and match_rules_in_document (the same text, scanned). Exits with status 1
+and prints the differences if they don't.
+
+Usage: python benchmarks/check_verdicts.py [--docs N] [--seed S]
+
+The children are synthetic documents (see corpus.py) plus texts with characters the FTS5
+tokenizer treats its own way (ordinal indicators, ligatures, accents, uppercase), and the
+rules are every rule of the corpus plus rules written with those characters.
+"""
+import argparse
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import database
+import processor
+from corpus import generate_corpus
+
+SPECIAL_TEXTS = {
+    "DIR_MRE_901_2031_caracteres.txt": (
+        "DIRECTIVA N° 901-2031-MRE\n"
+        "La 1ª convocatoria del Nº registro exige ﬁrma digital.\n\n"
+        "ARTÍCULO 1. Ámbito\n"
+        "El ÓRGANO COMPETENTE deberá publicar la información según el cronograma aprobado.\n\n"
+        "ARTÍCULO 2. Vigencia\n"
+        "La 2ª etapa comprende el registro Nº 15, la ﬁscalización y la pingüinera de Ñuñoa.\n"),
+    "DIR_MRE_902_2031_caracteres.txt": (
+        "DIRECTIVA N° 902-2031-MRE\n"
+        "Las entidades no podrán exigir la ﬁrma manuscrita ni el Nº de expediente en la 1ª instancia.\n"),
+}
+SPECIAL_RULES = [
+    "La 1ª convocatoria del Nº registro exige ﬁrma digital.",
+    "Las entidades deben exigir la firma digital en la primera convocatoria.",
+    "El órgano competente debe publicar la informacion segun el cronograma.",
+    "No podrán exigir el N° de expediente en la 1a instancia.",
+    "La fiscalización de la pingüinera corresponde al registro Nº 15.",
+]
+
+def check(n_docs, seed):
+    """Returns [(filename, rule, batch verdict, stored verdict)] for every rule where the paths differ"""
+    with tempfile.TemporaryDirectory() as tmp:
+        docs_dir = os.path.join(tmp, "documentos")
+        generate_corpus(docs_dir, n_docs, seed=seed)
+        for filename, text in SPECIAL_TEXTS.items():
+            with open(os.path.join(docs_dir, filename), "w", encoding="utf-8") as f:
+                f.write(text)
+        database.DB_PATH = os.path.join(tmp, "check.db")
+        database.init_db()
+        docs_dir_before = processor.DOCS_DIR
+        processor.DOCS_DIR = docs_dir
+        try:
+            processor.scan_directory(workers=1)
+            docs = database.get_all_docs()
+            rules = sorted({rule for doc_id, _ in docs for rule, _ in database.get_rules_for_doc(doc_id)})
+            rules += SPECIAL_RULES
+            differences = []
+            for doc_id, filename in docs:
+                batch = processor.check_compliance_batch(database.get_doc_content(doc_id), rules)
+                stored = [status for status, _ in processor.match_rules_in_document(doc_id, rules)]
+                differences += [(filename, rule, a, b) for rule, a, b in zip(rules, batch, stored) if a != b]
+        finally:
+            processor.DOCS_DIR = docs_dir_before
+            database.close_connection()
+    return differences
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--docs", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    differences = check(args.docs, args.seed)
+    for filename, rule, batch, stored in differences[:20]:
+        print(f"{filename}: {batch} (batch) != {stored} (stored): {rule[:80]}")
+    print(f"{len(differences)} different verdicts.")
+    return 1 if differences else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
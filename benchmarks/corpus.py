@@ -0,0 +1,132 @@
+"""
+Synthetic Peruvian-style legal corpora for the benchmarks, built from the templates in documentos/.
+
+Usage: python benchmarks/corpus.py OUT_DIR [n_docs] [seed]   (default: 200 documents, seed 0)
+
+Documents form a layered hierarchy like the real one: laws and legislative decrees at the top,
+then supreme decrees, ministerial resolutions and finally directives (which nobody cites).
+Each one is named and headed like its real counterpart (LEY_PERU_40012_2031_..., "Decreto
+Supremo N° 012-2031-PCM"), so it gets the same citation keys, and its body is sampled from the
+template lines: section headers, plain paragraphs and obligation/prohibition lines, plus
+citations of documents from the layers above (a share of them to documents not in the corpus).
+The output only depends on the arguments and the templates.
+"""
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import processor
+
+# Document kinds from the top of the hierarchy down, with their share of the corpus
+LAYERS = [("LEY", 0.05), ("DLEG", 0.05), ("DS", 0.15), ("RM", 0.25), ("DIR", 0.50)]
+
+# Citation numbers of documents that are not in the corpus (rendered like any other)
+MISSING_NUMBER_BASE = 90000
+
+CITATION_SENTENCES = [
+    "De conformidad con lo dispuesto en {label}, se aprueban las presentes disposiciones.",
+    "Conforme a {label}, las entidades adecuan sus procedimientos internos.",
+    "En el marco de lo establecido por {label} y sus normas complementarias.",
+    "Lo dispuesto en {label} es de aplicación supletoria.",
+]
+
+def load_templates(docs_dir=processor.DOCS_DIR):
+    """Splits the template documents into section headers, rule lines and plain lines (without citations)"""
+    headers, rules, plain = [], [], []
+    for filename in sorted(os.listdir(docs_dir)):
+        if not filename.endswith(".txt"):
+            continue
+        with open(os.path.join(docs_dir, filename), "r", encoding="utf-8", errors="ignore") as f:
+            for line in f:
+                line = line.strip()
+                if len(line) < 20 or processor.CITATION_PATTERN.search(line):
+                    continue
+                if processor.is_section_header(line):
+                    headers.append(line)
+                elif processor.find_rules(line):
+                    rules.append(line)
+                else:
+                    plain.append(line)
+    return headers, rules, plain
+
+def _identity(kind, index):
+    """(filename, header line, citation label or None) of the index-th document of a kind"""
+    year = 2030 + index % 5
+    if kind == "LEY":
+        number = 40000 + index
+        return f"LEY_PERU_{number}_{year}_sintetica.txt", f"LEY N° {number}", f"Ley N° {number}"
+    if kind == "DLEG":
+        number = 2000 + index
+        return (f"DLEG_{number}_{year}_sintetico.txt", f"DECRETO LEGISLATIVO N° {number}",
+                f"Decreto Legislativo N° {number}")
+    if kind == "DS":
+        number = index + 1
+        return (f"REGL_PCM_DS{number}_{year}_sintetico.txt", f"DECRETO SUPREMO N° {number:03d}-{year}-PCM",
+                f"Decreto Supremo N° {number:03d}-{year}-PCM")
+    if kind == "RM":
+        number = index + 1
+        return (f"RM_{number}_{year}_RE_sintetica.txt", f"RESOLUCIÓN MINISTERIAL N° {number:03d}-{year}-RE",
+                f"Resolución Ministerial N° {number:03d}-{year}-RE")
+    return f"DIR_MRE_{index + 1:03d}_{year}_sintetica.txt", f"DIRECTIVA N° {index + 1:03d}-{year}-MRE", None
+
+def _missing_label(rng):
+    number = MISSING_NUMBER_BASE + rng.randrange(10000)
+    return rng.choice([f"Ley N° {number}", f"Decreto Supremo N° {number}-2029-PCM",
+                       f"Resolución Ministerial N° {number}-2029-RE"])
+
+def generate_corpus(out_dir, n_docs, seed=0, doc_chars=20000, cites_per_doc=6, missing_ratio=0.2,
+                    rule_ratio=0.15, templates=None):
+    """
+    Writes n_docs synthetic documents of about doc_chars characters into out_dir.
+    Each document cites about cites_per_doc documents, missing_ratio of them absent from the
+    corpus, and rule_ratio of its lines are obligations or prohibitions. Returns the filenames.
+    """
+    rng = random.Random(seed)
+    headers, rules, plain = templates or load_templates()
+    os.makedirs(out_dir, exist_ok=True)
+
+    # Identities, layer by layer; citable labels accumulate for the layers below
+    documents = []
+    counts = {kind: max(1, round(n_docs * share)) for kind, share in LAYERS}
+    counts["DIR"] = max(1, n_docs - sum(n for kind, n in counts.items() if kind != "DIR"))
+    for kind, _ in LAYERS:
+        for index in range(counts[kind]):
+            documents.append(_identity(kind, index))
+
+    filenames = []
+    citable = []
+    for filename, header, label in documents:
+        lines = [header, rng.choice(plain), ""]
+        size = 0
+        article = 0
+        cited = 0
+        while size < doc_chars:
+            if rng.random() < 0.08:
+                article += 1
+                line = rng.choice(headers) if rng.random() < 0.3 else f"ARTÍCULO {article}. {rng.choice(plain)[:60]}"
+                lines.append("")
+            elif cited < cites_per_doc and rng.random() < cites_per_doc * 150 / doc_chars:
+                cited += 1
+                target = rng.choice(citable) if citable and rng.random() >= missing_ratio else _missing_label(rng)
+                line = rng.choice(CITATION_SENTENCES).format(label=target)
+            elif rng.random() < rule_ratio:
+                line = rng.choice(rules)
+            else:
+                line = rng.choice(plain)
+            lines.append(line)
+            size += len(line) + 1
+
+        with open(os.path.join(out_dir, filename), "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        filenames.append(filename)
+        if label:
+            citable.append(label)
+    return filenames
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.exit("Usage: python benchmarks/corpus.py OUT_DIR [n_docs] [seed]")
+    out = generate_corpus(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 200,
+                          seed=int(sys.argv[3]) if len(sys.argv) > 3 else 0)
+    print(f"Wrote {len(out)} documents to {sys.argv[1]}")
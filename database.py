@@ -1,12 +1,117 @@
 import sqlite3
 import os
+import functools
+import hashlib
+import json
+import re
+import threading
+import zlib
+from contextlib import contextmanager
+from instrumentation import timed, set_changes_counter
+
+try:
+    import zstandard  # Optional: only needed for CONTENT_CODEC "zstd" (pip install zstandard)
+except ImportError:
+    zstandard = None
 
 DB_PATH = "doc_auditor.db"
 
+# How document text is stored (see _add_content_store): "zlib", "zstd" or "none" (plain text in
+# docs.content and doc_chunks.content, as before). Already stored text stays readable after a change.
+CONTENT_CODEC = os.environ.get("DOC_AUDITOR_CONTENT_CODEC", "zlib")
+
+# Compressed documents are split into blobs of this many characters, so reading a section
+# or a piece of evidence decompresses only the blobs it overlaps
+CONTENT_BLOB_CHARS = 64 * 1024
+
+# Full-text rows of a section use rowid (doc_id << SECTION_ROWID_BITS) + position,
+# so all the sections of one document are a rowid range of sections_fts
+SECTION_ROWID_BITS = 20
+
+# Tokenizer of the full-text tables, and of tokenize (which must give the same terms)
+FTS_TOKENIZER = "unicode61 remove_diacritics 2"
+
+# One connection per thread, reused across calls (sqlite3 connections can't be shared between threads)
+_local = threading.local()
+
+def get_connection():
+    """Returns the calling thread's connection to DB_PATH, opening it (in WAL mode) on first use"""
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.path != DB_PATH:
+        if conn is not None:
+            conn.close()
+        conn = sqlite3.connect(DB_PATH, timeout=30)
+        # WAL lets the UI keep reading while a scan is writing
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _local.conn = conn
+        _local.path = DB_PATH
+        _local.depth = 0
+    return conn
+
+def close_connection():
+    """Closes the calling thread's connection (a new one is opened on next use)"""
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
+def _total_changes():
+    """Rows written by the calling thread, for the instrumentation's "rows touched"; never opens the DB"""
+    conn = getattr(_local, "conn", None)
+    return conn.total_changes if conn is not None else 0
+
+set_changes_counter(_total_changes)
+
+@contextmanager
+def transaction():
+    """
+    Unit of work: everything written inside the block is committed at once,
+    or rolled back on error. Nested blocks join the outermost transaction, so
+    e.g. a document, its dependencies and its rules can be saved together.
+    """
+    conn = get_connection()
+    _local.depth += 1
+    try:
+        yield conn
+    except BaseException:
+        _local.depth -= 1
+        if _local.depth == 0:
+            conn.rollback()
+        raise
+    _local.depth -= 1
+    if _local.depth == 0:
+        conn.commit()
+
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
+    """
+    Creates or upgrades the schema in place. The applied version is kept in PRAGMA user_version
+    and each pending migration runs once, in order, in the same transaction as the version bump.
+    Called on every session, so an up-to-date database is only read.
+    """
+    if get_connection().execute("PRAGMA user_version").fetchone()[0] == len(MIGRATIONS):
+        return
+    with transaction() as conn:
+        c = conn.cursor()
+        # sqlite3 only opens a transaction before INSERT/UPDATE/DELETE: without this BEGIN each
+        # CREATE or ALTER of a migration would be committed on its own. IMMEDIATE takes the write
+        # lock first, so a concurrent init_db waits and then reads the version this one leaves.
+        if not conn.in_transaction:
+            c.execute("BEGIN IMMEDIATE")
+        version = c.execute("PRAGMA user_version").fetchone()[0]
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            migration(c)
+            c.execute(f"PRAGMA user_version = {number}")
+
+def _create_schema(c):
+    # Migration 1: the schema before versioning. Every statement is idempotent, so databases
+    # created by older versions (user_version 0) are upgraded too. Later changes go in new migrations.
+    # Key/value metadata (e.g. the generation counter used to invalidate UI caches)
+    c.execute('''CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value INTEGER
+                )''')
+
     # Documents table
     c.execute('''CREATE TABLE IF NOT EXISTS docs (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -23,8 +128,14 @@ def init_db():
                     parent_ref_name TEXT,
                     parent_doc_id INTEGER,
                     status TEXT DEFAULT 'PENDING',
+                    citation_key TEXT,
+                    citation_type TEXT,
                     FOREIGN KEY(child_doc_id) REFERENCES docs(id)
                 )''')
+    # Databases created before citation keys existed
+    _add_column_if_missing(c, "dependencies", "citation_key", "TEXT")
+    _add_column_if_missing(c, "dependencies", "citation_type", "TEXT")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_dependencies_citation_key ON dependencies(citation_key)")
 
     # Rules table (Extracted constraints)
     c.execute('''CREATE TABLE IF NOT EXISTS rules (
@@ -35,127 +146,1172 @@ def init_db():
                     FOREIGN KEY(doc_id) REFERENCES docs(id)
                 )''')
 
-    conn.commit()
-    conn.close()
+    # General summary, computed at ingest time (NULL for documents scanned before it existed)
+    _add_column_if_missing(c, "docs", "summary", "TEXT")
+
+    # Sections detected at ingest time; bodies are slices of docs.content given by the offsets
+    c.execute('''CREATE TABLE IF NOT EXISTS sections (
+                    doc_id INTEGER,
+                    position INTEGER,
+                    title TEXT,
+                    start_offset INTEGER,
+                    end_offset INTEGER,
+                    summary TEXT,
+                    PRIMARY KEY (doc_id, position),
+                    FOREIGN KEY(doc_id) REFERENCES docs(id)
+                )''')
+
+    # Content of streamed (very large) documents, in chunks of whole lines; docs.content is NULL for them
+    c.execute('''CREATE TABLE IF NOT EXISTS doc_chunks (
+                    doc_id INTEGER,
+                    seq INTEGER,
+                    start_offset INTEGER,
+                    end_offset INTEGER,
+                    content TEXT,
+                    PRIMARY KEY (doc_id, seq),
+                    FOREIGN KEY(doc_id) REFERENCES docs(id)
+                )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_doc_chunks_end ON doc_chunks(doc_id, end_offset)")
+
+    # Canonical citation keys identifying each document (e.g. LEY-31814), used to resolve dependencies
+    c.execute('''CREATE TABLE IF NOT EXISTS doc_keys (
+                    citation_key TEXT,
+                    doc_id INTEGER,
+                    PRIMARY KEY (citation_key, doc_id),
+                    FOREIGN KEY(doc_id) REFERENCES docs(id)
+                )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_doc_keys_doc_id ON doc_keys(doc_id)")
+
+    # Cached compliance verdicts of a child against one parent's rule set.
+    # Keyed by content hashes and algorithm version, so any change is a cache miss
+    c.execute('''CREATE TABLE IF NOT EXISTS audit_cache (
+                    child_hash TEXT,
+                    ruleset_hash TEXT,
+                    algo_version INTEGER,
+                    child_doc_id INTEGER,
+                    parent_doc_id INTEGER,
+                    verdicts TEXT,
+                    PRIMARY KEY (child_hash, ruleset_hash, algo_version)
+                )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_audit_cache_child ON audit_cache(child_doc_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_audit_cache_parent ON audit_cache(parent_doc_id)")
+
+    # Results of the last batch audit (python -m doc_auditor audit), one row per child/parent rule
+    c.execute('''CREATE TABLE IF NOT EXISTS audit_results (
+                    child_doc_id INTEGER,
+                    parent_doc_id INTEGER,
+                    position INTEGER,
+                    rule_text TEXT,
+                    rule_type TEXT,
+                    status TEXT,
+                    evidence_start INTEGER,
+                    evidence_end INTEGER,
+                    audited_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (child_doc_id, parent_doc_id, position),
+                    FOREIGN KEY(child_doc_id) REFERENCES docs(id),
+                    FOREIGN KEY(parent_doc_id) REFERENCES docs(id)
+                )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_audit_results_parent ON audit_results(parent_doc_id)")
+
+    # File manifest (size, mtime and content hash of each scanned file)
+    # Used by the scanner to skip files that did not change since the last scan
+    c.execute('''CREATE TABLE IF NOT EXISTS file_manifest (
+                    filename TEXT PRIMARY KEY,
+                    doc_id INTEGER,
+                    size INTEGER,
+                    mtime_ns INTEGER,
+                    content_hash TEXT,
+                    FOREIGN KEY(doc_id) REFERENCES docs(id)
+                )''')
+
+    # Transitive closure of the resolved dependencies: every document each document inherits rules from.
+    # Maintained incrementally by the functions that change dependencies (see _refresh_ancestors)
+    if not _table_exists(c, "ancestors"):
+        c.execute('''CREATE TABLE ancestors (
+                        doc_id INTEGER,
+                        ancestor_id INTEGER,
+                        PRIMARY KEY (doc_id, ancestor_id),
+                        FOREIGN KEY(doc_id) REFERENCES docs(id),
+                        FOREIGN KEY(ancestor_id) REFERENCES docs(id)
+                    )''')
+        c.execute("CREATE INDEX idx_ancestors_ancestor ON ancestors(ancestor_id)")
+        _refresh_ancestors(c.connection)
+
+    # FTS5 full-text indexes (BM25 ranking), kept in sync by the write functions below.
+    # docs_fts and rules_fts index the rows of docs/rules in place (external content);
+    # sections_fts stores each section body, since sections only hold offsets
+    fts_tables = {
+        "docs_fts": "filename, content, content='docs', content_rowid='id'",
+        "rules_fts": "rule_text, rule_type UNINDEXED, doc_id UNINDEXED, content='rules', content_rowid='id'",
+        "sections_fts": "title, body, doc_id UNINDEXED, position UNINDEXED",
+    }
+    for table, columns in fts_tables.items():
+        if _table_exists(c, table):
+            continue
+        c.execute(f"CREATE VIRTUAL TABLE {table} USING fts5({columns}, tokenize='{FTS_TOKENIZER}')")
+        # Databases created before the full-text indexes existed
+        if table == "sections_fts":
+            # Sliced in SQL from where text was stored then: docs.content, or doc_chunks.content for
+            # streamed documents (chunks come in order: they are contiguous, so end_offset follows seq)
+            c.execute(f'''
+                INSERT INTO sections_fts (rowid, title, body, doc_id, position)
+                SELECT (s.doc_id << {SECTION_ROWID_BITS}) + s.position, s.title,
+                       COALESCE(substr(d.content, s.start_offset + 1, s.end_offset - s.start_offset),
+                                (SELECT group_concat(substr(k.content, max(s.start_offset - k.start_offset, 0) + 1,
+                                                            min(s.end_offset, k.end_offset) - max(s.start_offset, k.start_offset)), '')
+                                 FROM doc_chunks k
+                                 WHERE k.doc_id = s.doc_id AND k.end_offset > s.start_offset AND k.start_offset < s.end_offset),
+                                ''),
+                       s.doc_id, s.position
+                FROM sections s JOIN docs d ON d.id = s.doc_id
+            ''')
+        else:
+            c.execute(f"INSERT INTO {table}({table}) VALUES('rebuild')")
+
+def _add_indexes_and_constraints(c):
+    """Migration 2: indexes for the hot lookups (see HOT_QUERIES) and UNIQUE constraints"""
+    # Duplicates left by older scans would violate the new constraints
+    compact_rules()
+    c.execute('''DELETE FROM dependencies WHERE citation_key IS NOT NULL AND id NOT IN (
+                    SELECT MIN(id) FROM dependencies WHERE citation_key IS NOT NULL
+                    GROUP BY child_doc_id, citation_key)''')
+    c.execute("DROP INDEX IF EXISTS idx_dependencies_child")  # Superseded by idx_dependencies_child_ref
+
+    # One row per citation key and child; one row per rule and document
+    c.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_dependencies_child_key
+                 ON dependencies(child_doc_id, citation_key) WHERE citation_key IS NOT NULL''')
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_rules_unique ON rules(doc_id, rule_text, rule_type)")
+
+    # child -> parents (also add_dependency's existence check), parent -> children, rules of a document,
+    # manifest entry of a document (get_doc_hash)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_dependencies_child_ref ON dependencies(child_doc_id, parent_ref_name)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_dependencies_parent ON dependencies(parent_doc_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_rules_doc ON rules(doc_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_file_manifest_doc ON file_manifest(doc_id)")
+
+def _add_scan_jobs(c):
+    """Migration 3: background scan jobs, with their progress"""
+    c.execute('''CREATE TABLE IF NOT EXISTS scan_jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    status TEXT NOT NULL,  -- running, done, cancelled, failed
+                    pid INTEGER,           -- Process running the job
+                    started_at REAL,
+                    updated_at REAL,
+                    finished_at REAL,
+                    files_done INTEGER DEFAULT 0,
+                    files_total INTEGER,
+                    bytes_done INTEGER DEFAULT 0,
+                    bytes_total INTEGER,
+                    current_file TEXT,
+                    cancel_requested INTEGER DEFAULT 0,
+                    stats TEXT,            -- JSON of scan_directory's result
+                    error TEXT
+                )''')
+    # At most one running scan, whoever starts it (the INSERT of a second one fails)
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_scan_jobs_running ON scan_jobs(status) WHERE status = 'running'")
+
+def _add_content_store(c):
+    """
+    Migration 4: content-addressed store of compressed document text. With compression on,
+    docs.content is NULL and the text is in doc_chunks rows pointing to content_blobs by the
+    hash of their text, so identical texts are stored once. Text stored before stays inline
+    until its document is rescanned or `python database.py compress` runs.
+    docs_fts still indexes the full text but can't read it back from docs.content anymore:
+    never 'rebuild' it (_unindex_document passes the old values explicitly).
+    """
+    c.execute('''CREATE TABLE IF NOT EXISTS content_blobs (
+                    hash TEXT PRIMARY KEY,  -- sha256 of the UTF-8 text
+                    codec TEXT NOT NULL,    -- zlib or zstd
+                    length INTEGER,         -- Characters of the text
+                    data BLOB NOT NULL
+                )''')
+    _add_column_if_missing(c, "doc_chunks", "blob_hash", "TEXT")  # doc_chunks.content is NULL when set
+    c.execute("CREATE INDEX IF NOT EXISTS idx_doc_chunks_blob ON doc_chunks(blob_hash) WHERE blob_hash IS NOT NULL")
+    # Streamed documents are in docs_fts without their content, compressed ones with it
+    _add_column_if_missing(c, "docs", "streamed", "INTEGER NOT NULL DEFAULT 0")
+    c.execute("UPDATE docs SET streamed = 1 WHERE content IS NULL")
+
+def _add_doc_numbers(c):
+    """Migration 5: indexed numbers for resolve_dependencies' fallback, so touched documents are found without a scan"""
+    # Numeric filename tokens of each document (see _filename_numbers)
+    c.execute('''CREATE TABLE IF NOT EXISTS doc_numbers (
+                    number TEXT,
+                    doc_id INTEGER,
+                    PRIMARY KEY (number, doc_id),
+                    FOREIGN KEY(doc_id) REFERENCES docs(id)
+                )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_doc_numbers_doc ON doc_numbers(doc_id)")
+    for doc_id, filename in c.execute("SELECT id, filename FROM docs").fetchall():
+        c.executemany("INSERT OR IGNORE INTO doc_numbers (number, doc_id) VALUES (?, ?)",
+                      [(number, doc_id) for number in _filename_numbers(filename)])
+    # Number cited by each dependency (see _citation_number)
+    _add_column_if_missing(c, "dependencies", "citation_number", "TEXT")
+    c.executemany("UPDATE dependencies SET citation_number=? WHERE id=?",
+                  [(_citation_number(key), dep_id)
+                   for dep_id, key in c.execute("SELECT id, citation_key FROM dependencies").fetchall()])
+    c.execute("CREATE INDEX IF NOT EXISTS idx_dependencies_citation_number ON dependencies(citation_number)")
+
+def _add_scan_job_tokens(c):
+    """Migration 6: token of the process running a scan job, since a restarted container can reuse its pid"""
+    _add_column_if_missing(c, "scan_jobs", "process_token", "TEXT")
+
+def _make_sections_fts_contentless(c):
+    """
+    Migration 7: sections_fts only indexes the section bodies (contentless) instead of keeping
+    an uncompressed copy of them, larger than the compressed text; bodies and snippets are read
+    from the content store through the section offsets
+    """
+    c.execute("DROP TABLE IF EXISTS sections_fts")
+    c.execute(f"CREATE VIRTUAL TABLE sections_fts USING fts5(title, body, content='', tokenize='{FTS_TOKENIZER}')")
+    for doc_id, in c.execute("SELECT DISTINCT doc_id FROM sections").fetchall():
+        _index_sections(c.connection, doc_id)
+
+# Schema migrations, applied in order by init_db; never edit one that has shipped, append a new one
+MIGRATIONS = [
+    _create_schema,
+    _add_indexes_and_constraints,
+    _add_scan_jobs,
+    _add_content_store,
+    _add_doc_numbers,
+    _add_scan_job_tokens,
+    _make_sections_fts_contentless,
+]
+
+def _table_exists(c, table):
+    c.execute("SELECT 1 FROM sqlite_master WHERE name=?", (table,))
+    return c.fetchone() is not None
 
+def _add_column_if_missing(c, table, column, decl):
+    c.execute(f"PRAGMA table_info({table})")
+    if column not in [row[1] for row in c.fetchall()]:
+        c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+@timed
 def add_document(filename, content):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    try:
-        c.execute("INSERT INTO docs (filename, content) VALUES (?, ?)", (filename, content))
-        doc_id = c.lastrowid
-    except sqlite3.IntegrityError:
+    """Stores a document's text; content is None for streamed documents (see add_content_chunk)"""
+    compressed = content is not None and CONTENT_CODEC != "none"
+    with transaction() as conn:
+        c = conn.cursor()
         c.execute("SELECT id FROM docs WHERE filename=?", (filename,))
-        doc_id = c.fetchone()[0]
-        # Update content just in case
-        c.execute("UPDATE docs SET content=? WHERE id=?", (content, doc_id))
-    conn.commit()
-    conn.close()
+        row = c.fetchone()
+        if row:
+            doc_id = row[0]
+            _unindex_document(conn, doc_id)
+            # The sections' offsets are into the old text (the caller stores the new ones)
+            _unindex_sections(conn, doc_id)
+            c.execute("DELETE FROM sections WHERE doc_id=?", (doc_id,))
+            # Update content just in case
+            c.execute("UPDATE docs SET content=?, streamed=? WHERE id=?",
+                      (None if compressed else content, content is None, doc_id))
+            _delete_chunks(conn, doc_id)
+            invalidate_audit_cache(doc_id)
+        else:
+            c.execute("INSERT INTO docs (filename, content, streamed) VALUES (?, ?, ?)",
+                      (filename, None if compressed else content, content is None))
+            doc_id = c.lastrowid
+            c.executemany("INSERT INTO doc_numbers (number, doc_id) VALUES (?, ?)",
+                          [(number, doc_id) for number in _filename_numbers(filename)])
+        if compressed:
+            _store_compressed(conn, doc_id, content)
+        # Streamed documents (content NULL) are only searchable through their sections
+        c.execute("INSERT INTO docs_fts (rowid, filename, content) VALUES (?, ?, ?)", (doc_id, filename, content))
+        _bump_generation(conn)
     return doc_id
 
+def _unindex_document(conn, doc_id):
+    # FTS5 needs the indexed values to remove them, so this runs before docs changes.
+    # Compressed text is no longer in docs.content (see _add_content_store): pass it explicitly
+    row = conn.execute("SELECT filename, streamed FROM docs WHERE id=?", (doc_id,)).fetchone()
+    if row:
+        conn.execute("INSERT INTO docs_fts (docs_fts, rowid, filename, content) VALUES ('delete', ?, ?, ?)",
+                     (doc_id, row[0], None if row[1] else get_doc_content(doc_id)))
+
+def _store_compressed(conn, doc_id, content):
+    """Stores a document's text as chunks of CONTENT_BLOB_CHARS characters, each one a blob"""
+    rows = []
+    for seq, start in enumerate(range(0, len(content), CONTENT_BLOB_CHARS)):
+        piece = content[start:start + CONTENT_BLOB_CHARS]
+        rows.append((doc_id, seq, start, start + len(piece), _store_blob(conn, piece)))
+    conn.executemany("INSERT INTO doc_chunks (doc_id, seq, start_offset, end_offset, blob_hash) VALUES (?, ?, ?, ?, ?)", rows)
+
+def _store_blob(conn, text):
+    """Stores text compressed with CONTENT_CODEC, unless the same text is already stored; returns its hash"""
+    data = text.encode("utf-8")
+    blob_hash = hashlib.sha256(data).hexdigest()
+    if conn.execute("SELECT 1 FROM content_blobs WHERE hash=?", (blob_hash,)).fetchone() is None:
+        if CONTENT_CODEC == "zstd":
+            if zstandard is None:
+                raise RuntimeError("CONTENT_CODEC 'zstd' needs the zstandard package (pip install zstandard)")
+            codec, data = "zstd", zstandard.ZstdCompressor(level=10).compress(data)
+        else:
+            codec, data = "zlib", zlib.compress(data, 6)
+        conn.execute("INSERT INTO content_blobs (hash, codec, length, data) VALUES (?, ?, ?, ?)",
+                     (blob_hash, codec, len(text), data))
+    return blob_hash
+
+BLOB_QUERY = "SELECT codec, data FROM content_blobs WHERE hash=?"
+
+@functools.lru_cache(maxsize=8)
+def _blob_text(blob_hash):
+    """Decompressed text of a blob. Safe to cache: a hash always names the same text"""
+    codec, data = get_connection().execute(BLOB_QUERY, (blob_hash,)).fetchone()
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("This database has zstd-compressed text: pip install zstandard")
+        data = zstandard.ZstdDecompressor().decompress(data)
+    else:
+        data = zlib.decompress(data)
+    return data.decode("utf-8")
+
+DELETE_UNUSED_BLOB_QUERY = "DELETE FROM content_blobs WHERE hash=? AND NOT EXISTS (SELECT 1 FROM doc_chunks WHERE blob_hash=?)"
+
+def _delete_chunks(conn, doc_id):
+    """Deletes a document's chunks and the blobs that no other chunk uses"""
+    hashes = conn.execute("SELECT DISTINCT blob_hash FROM doc_chunks WHERE doc_id=? AND blob_hash IS NOT NULL",
+                          (doc_id,)).fetchall()
+    conn.execute("DELETE FROM doc_chunks WHERE doc_id=?", (doc_id,))
+    conn.executemany(DELETE_UNUSED_BLOB_QUERY, [(blob_hash, blob_hash) for blob_hash, in hashes])
+
+@timed
+def add_content_chunk(doc_id, seq, start_offset, content):
+    """Appends a chunk of a streamed document's content (see processor._ingest_streaming)"""
+    with transaction() as conn:
+        blob_hash = _store_blob(conn, content) if CONTENT_CODEC != "none" else None
+        conn.execute('''INSERT INTO doc_chunks (doc_id, seq, start_offset, end_offset, content, blob_hash)
+                        VALUES (?, ?, ?, ?, ?, ?)''',
+                     (doc_id, seq, start_offset, start_offset + len(content), None if blob_hash else content, blob_hash))
+
+CONTENT_RANGE_QUERY = '''
+    SELECT start_offset, content, blob_hash FROM doc_chunks
+    WHERE doc_id=? AND end_offset > ? AND start_offset < ?
+    ORDER BY seq
+'''
+
+@timed
+def get_content_range(doc_id, start, end):
+    """Returns content[start:end] of a document, reading (and decompressing) only the chunks that overlap it"""
+    rows = get_connection().execute(CONTENT_RANGE_QUERY, (doc_id, start, end)).fetchall()
+    if not rows:
+        row = get_connection().execute(
+            "SELECT substr(content, ? + 1, ?) FROM docs WHERE id=?", (start, end - start, doc_id)).fetchone()
+        return row[0] if row and row[0] else ""
+    return "".join((chunk if chunk is not None else _blob_text(blob_hash))[max(start - chunk_start, 0):end - chunk_start]
+                   for chunk_start, chunk, blob_hash in rows)
+
+DEPENDENCY_BY_REF_QUERY = "SELECT id FROM dependencies WHERE child_doc_id=? AND parent_ref_name=?"
+
 def add_dependency(child_doc_id, parent_ref_name):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    # Check if exists
-    c.execute("SELECT id FROM dependencies WHERE child_doc_id=? AND parent_ref_name=?", (child_doc_id, parent_ref_name))
-    if not c.fetchone():
-        c.execute("INSERT INTO dependencies (child_doc_id, parent_ref_name) VALUES (?, ?)", (child_doc_id, parent_ref_name))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        c = conn.cursor()
+        # Check if exists
+        c.execute(DEPENDENCY_BY_REF_QUERY, (child_doc_id, parent_ref_name))
+        if not c.fetchone():
+            c.execute("INSERT INTO dependencies (child_doc_id, parent_ref_name) VALUES (?, ?)", (child_doc_id, parent_ref_name))
+            _bump_generation(conn)
+
+@timed
+def replace_dependencies(child_doc_id, citations):
+    """
+    Replaces all the dependencies extracted from a document with a single executemany.
+    citations are dicts as returned by processor.find_dependencies (one row per citation key).
+    """
+    unique = {cit["key"]: cit for cit in citations}
+    with transaction() as conn:
+        conn.execute("DELETE FROM dependencies WHERE child_doc_id=?", (child_doc_id,))
+        conn.executemany('''INSERT INTO dependencies (child_doc_id, parent_ref_name, citation_key, citation_type,
+                                                     citation_number)
+                            VALUES (?, ?, ?, ?, ?)''',
+                         [(child_doc_id, cit["label"], cit["key"], cit["type"], _citation_number(cit["key"]))
+                          for cit in unique.values()])
+        _refresh_ancestors(conn, [child_doc_id])
+        _bump_generation(conn)
+
+DELETE_DOC_KEYS_QUERY = "DELETE FROM doc_keys WHERE doc_id=?"
+
+def replace_doc_keys(doc_id, keys):
+    """Replaces the citation keys that identify a document (see processor.find_document_keys)"""
+    with transaction() as conn:
+        conn.execute(DELETE_DOC_KEYS_QUERY, (doc_id,))
+        conn.executemany("INSERT OR IGNORE INTO doc_keys (citation_key, doc_id) VALUES (?, ?)",
+                         [(key, doc_id) for key in keys])
+
+@timed
+def replace_sections(doc_id, general_summary, sections):
+    """Stores the structure of a document (see processor.analyze_document_structure)"""
+    with transaction() as conn:
+        conn.execute("UPDATE docs SET summary=? WHERE id=?", (general_summary, doc_id))
+        _unindex_sections(conn, doc_id)
+        conn.execute("DELETE FROM sections WHERE doc_id=?", (doc_id,))
+        conn.executemany('''INSERT INTO sections (doc_id, position, title, start_offset, end_offset, summary)
+                            VALUES (?, ?, ?, ?, ?, ?)''',
+                         [(doc_id, i, sec["title"], sec["start"], sec["end"], sec["summary"])
+                          for i, sec in enumerate(sections)])
+        _index_sections(conn, doc_id)
+
+def add_section(doc_id, position, title, start_offset, end_offset):
+    """Appends a section of a streamed document, without its summary (see set_section_summaries)"""
+    with transaction() as conn:
+        conn.execute("INSERT INTO sections (doc_id, position, title, start_offset, end_offset) VALUES (?, ?, ?, ?, ?)",
+                     (doc_id, position, title, start_offset, end_offset))
+
+def set_section_summaries(doc_id, general_summary, summaries):
+    """
+    Stores the summaries of the sections added with add_section, given as (position, summary)
+    pairs (e.g. a generator, consumed one at a time), and indexes their text
+    """
+    with transaction() as conn:
+        conn.execute("UPDATE docs SET summary=? WHERE id=?", (general_summary, doc_id))
+        for position, summary in summaries:
+            conn.execute("UPDATE sections SET summary=? WHERE doc_id=? AND position=?", (summary, doc_id, position))
+        _index_sections(conn, doc_id)
+
+def _unindex_sections(conn, doc_id):
+    """
+    Removes a document's sections from sections_fts. The index is contentless, so it needs the
+    indexed text back: this runs while the sections and the document text are still the indexed ones
+    """
+    first_rowid = doc_id << SECTION_ROWID_BITS
+    for position, title, start, end, _ in iter_sections(doc_id):
+        conn.execute("INSERT INTO sections_fts (sections_fts, rowid, title, body) VALUES ('delete', ?, ?, ?)",
+                     (first_rowid + position, title, get_content_range(doc_id, start, end)))
+
+def _index_sections(conn, doc_id):
+    """Indexes the sections of a document (not indexed yet) from their offsets"""
+    first_rowid = doc_id << SECTION_ROWID_BITS
+    chunked = conn.execute("SELECT content IS NULL FROM docs WHERE id=?", (doc_id,)).fetchone()
+    if chunked and chunked[0]:
+        # Streamed or compressed: one section at a time, so large documents are never loaded whole
+        for position, title, start, end, _ in iter_sections(doc_id):
+            conn.execute("INSERT INTO sections_fts (rowid, title, body) VALUES (?, ?, ?)",
+                         (first_rowid + position, title, get_content_range(doc_id, start, end)))
+    else:
+        conn.execute('''
+            INSERT INTO sections_fts (rowid, title, body)
+            SELECT ? + s.position, s.title, substr(d.content, s.start_offset + 1, s.end_offset - s.start_offset)
+            FROM sections s JOIN docs d ON d.id = s.doc_id
+            WHERE s.doc_id=?
+        ''', (first_rowid, doc_id))
 
 def add_rule(doc_id, rule_text, rule_type):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("INSERT INTO rules (doc_id, rule_text, rule_type) VALUES (?, ?, ?)", (doc_id, rule_text, rule_type))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        c = conn.execute("INSERT OR IGNORE INTO rules (doc_id, rule_text, rule_type) VALUES (?, ?, ?)",
+                         (doc_id, rule_text, rule_type))
+        if c.rowcount:
+            conn.execute("INSERT INTO rules_fts (rowid, rule_text, rule_type, doc_id) VALUES (?, ?, ?, ?)",
+                         (c.lastrowid, rule_text, rule_type, doc_id))
+
+@timed
+def replace_rules(doc_id, rules):
+    """
+    Replaces the whole rule set of a document in a single transaction.
+    rules is a list of (rule_text, rule_type); repeated rules are stored once.
+    """
+    unique_rules = list(dict.fromkeys(rules))
+    with transaction() as conn:
+        _unindex_rules(conn, "doc_id=?", (doc_id,))
+        conn.execute("DELETE FROM rules WHERE doc_id=?", (doc_id,))
+        conn.executemany("INSERT INTO rules (doc_id, rule_text, rule_type) VALUES (?, ?, ?)",
+                         [(doc_id, text, rtype) for text, rtype in unique_rules])
+        conn.execute('''INSERT INTO rules_fts (rowid, rule_text, rule_type, doc_id)
+                        SELECT id, rule_text, rule_type, doc_id FROM rules WHERE doc_id=?''', (doc_id,))
+
+def _unindex_rules(conn, where, params):
+    # Like _unindex_document: must run while the rules rows still exist
+    conn.execute(f'''INSERT INTO rules_fts (rules_fts, rowid, rule_text, rule_type, doc_id)
+                     SELECT 'delete', id, rule_text, rule_type, doc_id FROM rules WHERE {where}''', params)
+
+def compact_rules():
+    """Removes duplicated rules left by older scans. Returns the number of deleted rows."""
+    duplicated = "id NOT IN (SELECT MIN(id) FROM rules GROUP BY doc_id, rule_text, rule_type)"
+    with transaction() as conn:
+        _unindex_rules(conn, duplicated, ())
+        c = conn.execute(f"DELETE FROM rules WHERE {duplicated}")
+        removed = c.rowcount
+    return removed
 
+def compress_documents():
+    """
+    Moves the text stored inline (before compression existed, or with CONTENT_CODEC "none") to
+    content_blobs, one document per transaction. Returns the number of documents converted;
+    the file only shrinks after a VACUUM.
+    """
+    if CONTENT_CODEC == "none":
+        return 0
+    conn = get_connection()
+    inline = [doc_id for doc_id, in conn.execute("SELECT id FROM docs WHERE content IS NOT NULL")]
+    chunked = [doc_id for doc_id, in conn.execute("SELECT DISTINCT doc_id FROM doc_chunks WHERE content IS NOT NULL")]
+    for doc_id in inline:
+        with transaction() as conn:
+            content, = conn.execute("SELECT content FROM docs WHERE id=?", (doc_id,)).fetchone()
+            conn.execute("UPDATE docs SET content=NULL WHERE id=?", (doc_id,))
+            _store_compressed(conn, doc_id, content)
+    for doc_id in chunked:
+        with transaction() as conn:
+            chunks = conn.execute("SELECT seq, content FROM doc_chunks WHERE doc_id=? AND content IS NOT NULL",
+                                  (doc_id,)).fetchall()
+            conn.executemany("UPDATE doc_chunks SET content=NULL, blob_hash=? WHERE doc_id=? AND seq=?",
+                             [(_store_blob(conn, chunk), doc_id, seq) for seq, chunk in chunks])
+    return len(inline) + len(chunked)
+
+@timed
 def get_all_docs():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT id, filename FROM docs")
-    rows = c.fetchall()
-    conn.close()
-    return rows
+    return get_connection().execute("SELECT id, filename FROM docs").fetchall()
+
+DOC_BY_ID_QUERY = "SELECT id, filename, streamed FROM docs WHERE id=?"
 
+@timed
 def get_doc_by_id(doc_id):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT id, filename, content FROM docs WHERE id=?", (doc_id,))
-    row = c.fetchone()
-    conn.close()
-    return row
-
-def get_dependencies_graph():
-    """Returns nodes and edges for the graph"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+    """(id, filename, streamed) of a document, or None; its text is loaded with get_doc_content"""
+    return get_connection().execute(DOC_BY_ID_QUERY, (doc_id,)).fetchone()
+
+DOC_CHUNKS_QUERY = "SELECT content, blob_hash FROM doc_chunks WHERE doc_id=? ORDER BY seq"
+
+@timed
+def get_doc_content(doc_id):
+    """
+    Whole text of a document (None if there is no such document), reassembled from its chunks
+    when streamed or compressed. get_content_range and get_section_content read just a part.
+    """
+    row = get_connection().execute("SELECT content FROM docs WHERE id=?", (doc_id,)).fetchone()
+    if row is None or row[0] is not None:
+        return row and row[0]
+    chunks = get_connection().execute(DOC_CHUNKS_QUERY, (doc_id,))
+    return "".join(chunk if chunk is not None else _blob_text(blob_hash) for chunk, blob_hash in chunks)
+
+def get_doc_summary(doc_id):
+    row = get_connection().execute("SELECT summary FROM docs WHERE id=?", (doc_id,)).fetchone()
+    return row[0] if row else None
+
+SECTIONS_QUERY = '''
+    SELECT position, title, start_offset, end_offset, summary
+    FROM sections WHERE doc_id=? ORDER BY position
+'''
+
+@timed
+def get_sections(doc_id):
+    """Returns [(position, title, start_offset, end_offset, summary)] without the section bodies"""
+    return get_connection().execute(SECTIONS_QUERY, (doc_id,)).fetchall()
+
+def iter_sections(doc_id):
+    """Like get_sections, but the rows are read as they are iterated (for documents with many sections)"""
+    return get_connection().execute(SECTIONS_QUERY, (doc_id,))
+
+SECTION_OFFSETS_QUERY = "SELECT start_offset, end_offset FROM sections WHERE doc_id=? AND position=?"
+
+@timed
+def get_section_content(doc_id, position):
+    """Returns one section's body, read from its offsets without loading the whole document"""
+    row = get_connection().execute(SECTION_OFFSETS_QUERY, (doc_id, position)).fetchone()
+    return get_content_range(doc_id, row[0], row[1]) if row else ""
+
+@timed
+def search_sections(match_query, doc_id=None, limit=10):
+    """
+    Full-text search over section titles and bodies, best BM25 match first.
+    match_query is an FTS5 query (see processor.to_fts_query). Returns
+    [(doc_id, filename, position, title, start_offset, end_offset, snippet, score)];
+    lower scores are better matches. With doc_id, only that document's sections are searched.
+    The index holds no text: the snippets come from the bodies read back from the content store.
+    """
+    params = [match_query]
+    doc_filter = ""
+    if doc_id is not None:
+        first_rowid = doc_id << SECTION_ROWID_BITS
+        doc_filter = "AND f.rowid BETWEEN ? AND ?"
+        params += [first_rowid, first_rowid + (1 << SECTION_ROWID_BITS) - 1]
+    rows = get_connection().execute(f'''
+        SELECT s.doc_id, d.filename, s.position, s.title, s.start_offset, s.end_offset, bm25(sections_fts, 2.0, 1.0)
+        FROM sections_fts f
+        JOIN sections s ON s.doc_id = f.rowid >> {SECTION_ROWID_BITS}
+                       AND s.position = f.rowid & {(1 << SECTION_ROWID_BITS) - 1}
+        JOIN docs d ON d.id = s.doc_id
+        WHERE sections_fts MATCH ? {doc_filter}
+        ORDER BY bm25(sections_fts, 2.0, 1.0)
+        LIMIT ?
+    ''', params + [limit]).fetchall()
+    # The query's words: quoted by processor.to_fts_query
+    terms = set(tokenize(" ".join(re.findall(r'"([^"]*)"', match_query)) or match_query))
+    return [(found_id, filename, position, title, start, end, _snippet(get_content_range(found_id, start, end), terms), score)
+            for found_id, filename, position, title, start, end, score in rows]
+
+def _snippet(text, terms, tokens=16):
+    """
+    Excerpt of text around the terms (as tokenize gives them), like FTS5's snippet(): the window
+    of that many words with the most distinct terms, the terms in **bold** and … where text was cut
+    """
+    spans = list(_term_spans(text))
+    hits = [i for i, (_, _, term) in enumerate(spans) if term in terms]
+    first = 0
+    if hits:
+        starts = [max(0, min(hit - tokens // 4, len(spans) - tokens)) for hit in hits]
+        first = max(starts, key=lambda start: (len({term for _, _, term in spans[start:start + tokens]} & terms), -start))
+    window = spans[first:first + tokens]
+    if not window:
+        return ""
+    parts = ["…" if first else ""]
+    pos = window[0][0]
+    for start, end, term in window:
+        parts.append(text[pos:start])
+        parts.append(f"**{text[start:end]}**" if term in terms else text[start:end])
+        pos = end
+    parts.append("…" if first + tokens < len(spans) else "")
+    return "".join(parts)
+
+@timed
+def get_section_postings(doc_id, term):
+    """
+    Positions of a document's sections whose body has a term (as tokenize gives it), looked up
+    in the full-text index within the document's rowid range, so the document is never read
+    """
+    first_rowid = doc_id << SECTION_ROWID_BITS
+    rows = get_connection().execute("SELECT rowid FROM sections_fts WHERE sections_fts MATCH ? AND rowid BETWEEN ? AND ?",
+                                    (f'body : "{term}"', first_rowid, first_rowid + (1 << SECTION_ROWID_BITS) - 1))
+    return [rowid - first_rowid for rowid, in rows]
+
+@timed
+def iter_section_bodies(doc_id):
+    """(position, body) of every section of a document, read one at a time from the content store"""
+    return ((position, get_content_range(doc_id, start, end)) for position, _, start, end, _ in iter_sections(doc_id))
+
+def _scratch_connection():
+    """The calling thread's in-memory FTS5 table, for asking the tokenizer what it does with a character"""
+    conn = getattr(_local, "scratch", None)
+    if conn is None:
+        conn = sqlite3.connect(":memory:", isolation_level=None)
+        conn.execute(f"CREATE VIRTUAL TABLE probes USING fts5(body, tokenize='{FTS_TOKENIZER}')")
+        conn.execute("CREATE VIRTUAL TABLE probe_terms USING fts5vocab(probes, 'instance')")
+        _local.scratch = conn
+    return conn
+
+# What the tokenizer turns each character seen so far into, as a str.translate table: the character
+# lowercased and without diacritics, "" when it is dropped (a combining accent) or " " (a separator).
+# unicode61 folds characters one at a time, so this reproduces its terms exactly.
+_TOKEN_CHARS = {}
+
+def _learn_token_chars(chars):
+    conn = _scratch_connection()
+    conn.execute("BEGIN")
+    try:
+        # "x" + char + "x" gives two terms when the character separates them, otherwise one
+        conn.executemany("INSERT INTO probes (rowid, body) VALUES (?, ?)", [(ord(ch), f"x{ch}x") for ch in chars])
+        terms = {}
+        for code, term in conn.execute("SELECT doc, term FROM probe_terms ORDER BY doc, offset"):
+            terms.setdefault(code, []).append(term)
+    finally:
+        conn.execute("ROLLBACK")  # Leaves the probe table empty
+    for ch in chars:
+        found = terms.get(ord(ch), [])
+        _TOKEN_CHARS[ord(ch)] = found[0][1:-1] if len(found) == 1 else " "
+
+def tokenize(text):
+    """Terms of text, in order, exactly as the full-text index sees them (lowercased, without diacritics)"""
+    unknown = {ch for ch in set(text) if ord(ch) not in _TOKEN_CHARS}
+    if unknown:
+        _learn_token_chars(unknown)
+    return text.translate(_TOKEN_CHARS).split()
+
+def _term_spans(text):
+    """(start, end, term) of every term of text (see tokenize), with its character offsets"""
+    tokenize(text)  # Learns the characters not seen yet
+    start = None
+    for i, ch in enumerate(text):
+        folded = _TOKEN_CHARS[ord(ch)]
+        if folded == " ":
+            if start is not None:
+                yield start, i, text[start:i].translate(_TOKEN_CHARS)
+                start = None
+        elif start is None and folded:
+            start = i
+    if start is not None:
+        yield start, len(text), text[start:].translate(_TOKEN_CHARS)
+
+@timed
+def index_passages(passages):
+    """
+    Inverted index of some passages, {term: [positions of the passages containing it]}, for an
+    iterable of (position, text); the terms are those of the full-text index (see tokenize).
+    """
+    index = {}
+    for position, text in passages:
+        for term in set(tokenize(text)):
+            index.setdefault(term, []).append(position)
+    return index
+
+@timed
+def search_documents(match_query, limit=10):
+    """Full-text search over whole documents (filename and content): [(doc_id, filename, score)], best first"""
+    return get_connection().execute('''
+        SELECT rowid, filename, bm25(docs_fts) FROM docs_fts
+        WHERE docs_fts MATCH ? ORDER BY bm25(docs_fts) LIMIT ?
+    ''', (match_query, limit)).fetchall()
+
+@timed
+def search_rules(match_query, limit=10):
+    """Full-text search over extracted rules: [(doc_id, filename, rule_text, rule_type, score)], best first"""
+    return get_connection().execute('''
+        SELECT f.doc_id, d.filename, f.rule_text, f.rule_type, bm25(rules_fts)
+        FROM rules_fts f JOIN docs d ON d.id = f.doc_id
+        WHERE rules_fts MATCH ? ORDER BY bm25(rules_fts) LIMIT ?
+    ''', (match_query, limit)).fetchall()
+
+# Documents within a number of hops of a root (params: root, depth, root, depth), for get_dependencies_graph
+NEIGHBORHOOD_CTE = '''
+    WITH RECURSIVE
+    up(id, hops) AS (
+        SELECT ?, 0
+        UNION
+        SELECT d.parent_doc_id, up.hops + 1
+        FROM dependencies d JOIN up ON d.child_doc_id = up.id
+        WHERE d.parent_doc_id IS NOT NULL AND up.hops < ?
+    ),
+    down(id, hops) AS (
+        SELECT ?, 0
+        UNION
+        SELECT d.child_doc_id, down.hops + 1
+        FROM dependencies d JOIN down ON d.parent_doc_id = down.id
+        WHERE down.hops < ?
+    ),
+    hood(id) AS (SELECT id FROM up UNION SELECT id FROM down)
+'''
+# Edges of the graph (parent_filename is NULL for unresolved references)
+GRAPH_EDGES_SELECT = '''
+    SELECT c.filename, p.filename, d.parent_ref_name, d.citation_type
+    FROM dependencies d
+    JOIN docs c ON c.id = d.child_doc_id
+    LEFT JOIN docs p ON p.id = d.parent_doc_id
+'''
+NEIGHBORHOOD_NODES_QUERY = f"{NEIGHBORHOOD_CTE} SELECT filename FROM docs WHERE id IN (SELECT id FROM hood)"
+NEIGHBORHOOD_EDGES_QUERY = f'''{NEIGHBORHOOD_CTE} {GRAPH_EDGES_SELECT}
+    WHERE d.child_doc_id IN (SELECT id FROM hood)
+      AND (d.parent_doc_id IS NULL OR d.parent_doc_id IN (SELECT id FROM hood))
+'''
+
+@timed
+def get_dependencies_graph(root_doc_id=None, depth=2):
+    """
+    Returns nodes and edges for the graph: the list of filenames and
+    (child_filename, parent_filename or None, parent_ref_name, citation_type) edges, joined in SQL.
+    With root_doc_id, only the documents within depth hops of it (its ancestors and
+    descendants, found with a recursive CTE) and the edges between them are returned.
+    """
+    c = get_connection().cursor()
+
+    if root_doc_id is None:
+        nodes_query, edges_query, params = "SELECT filename FROM docs", GRAPH_EDGES_SELECT, ()
+    else:
+        nodes_query, edges_query = NEIGHBORHOOD_NODES_QUERY, NEIGHBORHOOD_EDGES_QUERY
+        params = (root_doc_id, depth, root_doc_id, depth)
     
     # Nodes
-    c.execute("SELECT id, filename FROM docs")
-    docs = c.fetchall()
+    c.execute(nodes_query, params)
+    docs = [row[0] for row in c.fetchall()]
     
-    # Edges (Resolved dependencies only for now, or raw)
-    # We try to join dependencies with docs on parent_ref_name approx match or if parent_doc_id is set
-    c.execute('''
-        SELECT d.child_doc_id, d.parent_doc_id, d.parent_ref_name 
-        FROM dependencies d
-    ''')
+    # Edges
+    c.execute(edges_query, params)
     deps = c.fetchall()
     
-    conn.close()
     return docs, deps
 
-def resolve_dependencies():
-    """Attempts to link dependencies to actual doc IDs based on filenames"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    c.execute("SELECT id, filename FROM docs")
-    all_docs = c.fetchall()
-    
-    # Generic normalization for matching
-    # e.g. "Ley 30000.txt" -> "Ley 30000"
-    doc_map = {doc[1].replace(".txt","").lower(): doc[0] for doc in all_docs}
-    
-    c.execute("SELECT id, parent_ref_name FROM dependencies WHERE parent_doc_id IS NULL")
-    pending = c.fetchall()
-    
-    for dep_id, ref_name in pending:
-        # Simple heuristic matching
-        ref_clean = ref_name.lower().strip()
-        matched_id = None
-        
-        # Exact substring match in knowing filenames
-        for name, did in doc_map.items():
-            if name in ref_clean or ref_clean in name:
-                matched_id = did
-                break
-        
-        if matched_id:
-            c.execute("UPDATE dependencies SET parent_doc_id=?, status='RESOLVED' WHERE id=?", (matched_id, dep_id))
-            
-    conn.commit()
-    conn.close()
+def get_meta(key):
+    row = get_connection().execute("SELECT value FROM meta WHERE key=?", (key,)).fetchone()
+    return row[0] if row else None
+
+def set_meta(key, value):
+    with transaction() as conn:
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+def get_generation():
+    """Returns the DB generation counter, bumped whenever documents or dependencies change"""
+    row = get_connection().execute("SELECT value FROM meta WHERE key='generation'").fetchone()
+    return row[0] if row else 0
+
+def _bump_generation(conn):
+    conn.execute("INSERT INTO meta (key, value) VALUES ('generation', 1) "
+                 "ON CONFLICT(key) DO UPDATE SET value = value + 1")
+
+def _pending(touched):
+    # With touched documents, a unary + keeps SQLite from walking every pending dependency through
+    # idx_dependencies_parent: the rows are found through the indexes of the touched conditions
+    return "+parent_doc_id IS NULL" if touched else "parent_doc_id IS NULL"
+
+# Dependencies resolvable through doc_keys, and (tried next) through the cited number: exactly one
+# other document has it among its filename numbers. With touched (a number of documents) only the
+# dependencies of those documents, or citing one of their keys or numbers, found through indexes.
+def _resolvable_by_key(touched=None):
+    where = f'''{_pending(touched)}
+               AND EXISTS (SELECT 1 FROM doc_keys k
+                           WHERE k.citation_key = dependencies.citation_key
+                             AND k.doc_id != dependencies.child_doc_id)'''
+    if touched:
+        marks = ", ".join("?" * touched)
+        where += f'''
+               AND (child_doc_id IN ({marks})
+                    OR citation_key IN (SELECT citation_key FROM doc_keys WHERE doc_id IN ({marks})))'''
+    return where
 
+def _resolvable_by_number(touched=None):
+    where = f'''{_pending(touched)} AND citation_number IS NOT NULL
+               AND (SELECT COUNT(*) FROM doc_numbers n
+                    WHERE n.number = dependencies.citation_number AND n.doc_id != dependencies.child_doc_id) = 1'''
+    if touched:
+        marks = ", ".join("?" * touched)
+        where += f'''
+               AND (child_doc_id IN ({marks})
+                    OR citation_number IN (SELECT number FROM doc_numbers WHERE doc_id IN ({marks})))'''
+    return where
+
+def _resolve_statements(touched=None):
+    """[(query of the children gaining a parent, UPDATE)] run by resolve_dependencies, in order"""
+    by_key, by_number = _resolvable_by_key(touched), _resolvable_by_number(touched)
+    return [
+        (f"SELECT DISTINCT child_doc_id FROM dependencies WHERE {by_key}",
+         f'''UPDATE dependencies
+             SET parent_doc_id = (SELECT MIN(k.doc_id) FROM doc_keys k
+                                  WHERE k.citation_key = dependencies.citation_key
+                                    AND k.doc_id != dependencies.child_doc_id),
+                 status = 'RESOLVED'
+             WHERE {by_key}'''),
+        (f"SELECT DISTINCT child_doc_id FROM dependencies WHERE {by_number}",
+         f'''UPDATE dependencies
+             SET parent_doc_id = (SELECT n.doc_id FROM doc_numbers n
+                                  WHERE n.number = dependencies.citation_number
+                                    AND n.doc_id != dependencies.child_doc_id),
+                 status = 'RESOLVED'
+             WHERE {by_number}'''),
+    ]
+
+@timed
+def resolve_dependencies(doc_ids=None):
+    """
+    Links pending dependencies to doc IDs. Citation keys are looked up in the doc_keys index;
+    the ones left over fall back to matching the cited number against numeric filename tokens
+    (doc_numbers, e.g. LEY-31814 -> LEY_PERU_31814_...). Both are bulk UPDATEs.
+    With doc_ids (documents just added or changed) only the dependencies that can be
+    affected are considered: those of these documents and those citing their keys or
+    filename numbers, so the cost doesn't grow with the corpus.
+    """
+    params = ()
+    if doc_ids is not None:
+        doc_ids = list(doc_ids)
+        if not doc_ids:
+            return
+        params = tuple(doc_ids) * 2
+    with transaction() as conn:
+        # Documents gaining parents, whose ancestor closure has to be refreshed
+        changed = set()
+        for query, update in _resolve_statements(len(doc_ids) if doc_ids is not None else None):
+            changed.update(child_id for child_id, in conn.execute(query, params))
+            conn.execute(update, params)
+        _bump_generation(conn)
+        _refresh_ancestors(conn, sorted(changed))
+
+def _filename_numbers(filename):
+    """Numeric tokens of a filename that can identify it; shorter than 3 digits (e.g. directive 005) is too ambiguous"""
+    return {str(int(token)) for token in os.path.splitext(filename)[0].split("_")
+            if token.isdigit() and len(str(int(token))) >= 3}
+
+def _citation_number(key):
+    """Number of a citation key (format PREFIX-NUMBER[-YEAR-ISSUER]), as in doc_numbers"""
+    parts = key.split("-") if key else ()
+    return str(int(parts[1])) if len(parts) > 1 and parts[1].isdigit() else None
+
+# Ancestor closure of the documents in the ancestors_seed temp table
+REFRESH_ANCESTORS_QUERY = '''
+    WITH RECURSIVE reach(doc_id, ancestor_id) AS (
+        SELECT d.child_doc_id, d.parent_doc_id FROM dependencies d
+        WHERE d.child_doc_id IN (SELECT doc_id FROM ancestors_seed) AND d.parent_doc_id IS NOT NULL
+        UNION
+        SELECT reach.doc_id, d.parent_doc_id
+        FROM reach JOIN dependencies d ON d.child_doc_id = reach.ancestor_id
+        WHERE d.parent_doc_id IS NOT NULL
+    )
+    INSERT INTO ancestors (doc_id, ancestor_id)
+    SELECT doc_id, ancestor_id FROM reach WHERE ancestor_id != doc_id
+'''
+
+@timed
+def _refresh_ancestors(conn, doc_ids=None):
+    """
+    Recomputes the ancestors of doc_ids (all documents when None) after their own dependencies
+    changed. Their descendants are refreshed too: their paths up go through these documents.
+    The closure is one recursive CTE; UNION drops repeated pairs, so cycles terminate.
+    """
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS ancestors_seed (doc_id INTEGER PRIMARY KEY)")
+    conn.execute("DELETE FROM ancestors_seed")
+    if doc_ids is None:
+        conn.execute("INSERT INTO ancestors_seed SELECT id FROM docs")
+    else:
+        conn.executemany("INSERT OR IGNORE INTO ancestors_seed VALUES (?)", [(doc_id,) for doc_id in doc_ids])
+        conn.execute('''INSERT OR IGNORE INTO ancestors_seed
+                        SELECT doc_id FROM ancestors WHERE ancestor_id IN (SELECT doc_id FROM ancestors_seed)''')
+    conn.execute("DELETE FROM ancestors WHERE doc_id IN (SELECT doc_id FROM ancestors_seed)")
+    conn.execute(REFRESH_ANCESTORS_QUERY)
+
+RULES_FOR_DOC_QUERY = "SELECT rule_text, rule_type FROM rules WHERE doc_id=? ORDER BY id"
+
+@timed
 def get_rules_for_doc(doc_id):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT rule_text, rule_type FROM rules WHERE doc_id=?", (doc_id,))
-    data = c.fetchall()
-    conn.close()
-    return data
+    return get_connection().execute(RULES_FOR_DOC_QUERY, (doc_id,)).fetchall()
 
+PARENT_DOCS_QUERY = '''
+    SELECT DISTINCT p.id, p.filename
+    FROM dependencies d
+    JOIN docs p ON d.parent_doc_id = p.id
+    WHERE d.child_doc_id = ?
+'''
+
+@timed
 def get_parent_docs(child_doc_id):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    # Returns list of parent docs (actual objects if resolved)
-    c.execute('''
-        SELECT p.id, p.filename 
-        FROM dependencies d
-        JOIN docs p ON d.parent_doc_id = p.id
-        WHERE d.child_doc_id = ?
-    ''', (child_doc_id,))
-    parents = c.fetchall()
-    conn.close()
-    return parents
+    # Returns list of parent docs (actual objects if resolved), once even if cited with several keys
+    return get_connection().execute(PARENT_DOCS_QUERY, (child_doc_id,)).fetchall()
+
+ANCESTOR_DOCS_QUERY = '''
+    SELECT p.id, p.filename
+    FROM ancestors a
+    JOIN docs p ON a.ancestor_id = p.id
+    WHERE a.doc_id = ?
+    ORDER BY p.id
+'''
+
+@timed
+def get_ancestor_docs(child_doc_id):
+    """
+    Returns every document a document inherits rules from (its parents, their parents, ...)
+    as (id, filename), read from the materialized ancestors table
+    """
+    return get_connection().execute(ANCESTOR_DOCS_QUERY, (child_doc_id,)).fetchall()
+
+DOC_HASH_QUERY = "SELECT content_hash FROM file_manifest WHERE doc_id=?"
+
+@timed
+def get_doc_hash(doc_id):
+    """Returns the content hash recorded for a document at scan time (None if unknown)"""
+    row = get_connection().execute(DOC_HASH_QUERY, (doc_id,)).fetchone()
+    return row[0] if row else None
+
+AUDIT_CACHE_QUERY = "SELECT ruleset_hash, verdicts FROM audit_cache WHERE child_hash=? AND algo_version=?"
+
+@timed
+def get_audit_cache(child_hash, algo_version):
+    """Returns {ruleset_hash: verdicts} cached for a child document with a single indexed SELECT"""
+    rows = get_connection().execute(AUDIT_CACHE_QUERY, (child_hash, algo_version)).fetchall()
+    return {ruleset_hash: json.loads(verdicts) for ruleset_hash, verdicts in rows}
+
+@timed
+def save_audit_cache(child_doc_id, parent_doc_id, child_hash, ruleset_hash, algo_version, verdicts):
+    with transaction() as conn:
+        conn.execute('''INSERT OR REPLACE INTO audit_cache
+                        (child_hash, ruleset_hash, algo_version, child_doc_id, parent_doc_id, verdicts)
+                        VALUES (?, ?, ?, ?, ?, ?)''',
+                     (child_hash, ruleset_hash, algo_version, child_doc_id, parent_doc_id, json.dumps(verdicts)))
+
+INVALIDATE_AUDIT_CACHE_QUERY = "DELETE FROM audit_cache WHERE child_doc_id=? OR parent_doc_id=?"
+
+def invalidate_audit_cache(doc_id):
+    """Drops cached verdicts involving a document, as child or as parent (called when it changes)"""
+    with transaction() as conn:
+        conn.execute(INVALIDATE_AUDIT_CACHE_QUERY, (doc_id, doc_id))
+
+def get_audited_children():
+    """Ids of the documents with at least one resolved parent, i.e. the ones a batch audit checks"""
+    return [doc_id for doc_id, in get_connection().execute(
+        "SELECT DISTINCT child_doc_id FROM dependencies WHERE parent_doc_id IS NOT NULL ORDER BY child_doc_id")]
+
+@timed
+def replace_audit_results(child_doc_id, report):
+    """Stores the batch audit of one child (a processor.audit_against_parents report), replacing the previous one"""
+    with transaction() as conn:
+        conn.execute("DELETE FROM audit_results WHERE child_doc_id=?", (child_doc_id,))
+        conn.executemany('''INSERT INTO audit_results
+                            (child_doc_id, parent_doc_id, position, rule_text, rule_type, status, evidence_start, evidence_end)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                         [(child_doc_id, p_id, i, text, rtype, status, *(evidence or (None, None)))
+                          for p_id, _, rules in report
+                          for i, (text, rtype, status, evidence) in enumerate(rules)])
+
+SCAN_JOB_COLUMNS = ["id", "status", "pid", "process_token", "started_at", "updated_at", "finished_at",
+                    "files_done", "files_total", "bytes_done", "bytes_total", "current_file", "cancel_requested",
+                    "stats", "error"]
+
+def create_scan_job(pid, process_token, now):
+    """Registers a running scan job and returns its id, or None if another scan is running"""
+    try:
+        with transaction() as conn:
+            return conn.execute('''INSERT INTO scan_jobs (status, pid, process_token, started_at, updated_at)
+                                   VALUES ('running', ?, ?, ?, ?)''', (pid, process_token, now, now)).lastrowid
+    except sqlite3.IntegrityError:
+        return None
+
+RUNNING_SCAN_JOB_QUERY = f"SELECT {', '.join(SCAN_JOB_COLUMNS)} FROM scan_jobs WHERE status = 'running'"
+
+def get_running_scan_job():
+    row = get_connection().execute(RUNNING_SCAN_JOB_QUERY).fetchone()
+    return dict(zip(SCAN_JOB_COLUMNS, row)) if row else None
+
+def get_scan_job(job_id=None):
+    """A scan job as a dict (stats decoded), by id or else the most recent one; None if there is none"""
+    query = f"SELECT {', '.join(SCAN_JOB_COLUMNS)} FROM scan_jobs"
+    row = get_connection().execute(query + " WHERE id = ?" if job_id else query + " ORDER BY id DESC LIMIT 1",
+                                   (job_id,) if job_id else ()).fetchone()
+    if not row:
+        return None
+    job = dict(zip(SCAN_JOB_COLUMNS, row))
+    job["stats"] = json.loads(job["stats"]) if job["stats"] else None
+    return job
+
+def update_scan_job_progress(job_id, files_done, files_total, bytes_done, bytes_total, current_file, now):
+    """Stores a running job's progress; returns whether its cancellation was requested"""
+    with transaction() as conn:
+        conn.execute('''UPDATE scan_jobs SET files_done = ?, files_total = ?, bytes_done = ?, bytes_total = ?,
+                        current_file = ?, updated_at = ? WHERE id = ?''',
+                     (files_done, files_total, bytes_done, bytes_total, current_file, now, job_id))
+        row = conn.execute("SELECT cancel_requested FROM scan_jobs WHERE id = ?", (job_id,)).fetchone()
+    return bool(row and row[0])
+
+def request_scan_cancel(job_id):
+    with transaction() as conn:
+        conn.execute("UPDATE scan_jobs SET cancel_requested = 1 WHERE id = ? AND status = 'running'", (job_id,))
+
+def finish_scan_job(job_id, status, now, stats=None, error=None):
+    with transaction() as conn:
+        conn.execute('''UPDATE scan_jobs SET status = ?, finished_at = ?, updated_at = ?, current_file = NULL,
+                        stats = ?, error = ? WHERE id = ?''',
+                     (status, now, now, json.dumps(stats) if stats is not None else None, error, job_id))
+
+@timed
+def get_manifest():
+    """Returns {filename: (doc_id, size, mtime_ns, content_hash)} for every scanned file"""
+    rows = get_connection().execute("SELECT filename, doc_id, size, mtime_ns, content_hash FROM file_manifest").fetchall()
+    return {row[0]: row[1:] for row in rows}
+
+MANIFEST_ENTRY_QUERY = "SELECT doc_id, size, mtime_ns, content_hash FROM file_manifest WHERE filename=?"
+
+def get_manifest_entry(filename):
+    """(doc_id, size, mtime_ns, content_hash) of one scanned file, or None"""
+    return get_connection().execute(MANIFEST_ENTRY_QUERY, (filename,)).fetchone()
+
+def update_manifest(filename, doc_id, size, mtime_ns, content_hash):
+    with transaction() as conn:
+        conn.execute('''INSERT OR REPLACE INTO file_manifest (filename, doc_id, size, mtime_ns, content_hash)
+                        VALUES (?, ?, ?, ?, ?)''', (filename, doc_id, size, mtime_ns, content_hash))
+
+# Documents citing a removed one, and the reset of their references (params: its id)
+CITING_DOCS_QUERY = "SELECT DISTINCT child_doc_id FROM dependencies WHERE parent_doc_id=?"
+RESET_CITATIONS_QUERY = "UPDATE dependencies SET parent_doc_id=NULL, status='PENDING' WHERE parent_doc_id=?"
+
+@timed
+def remove_document(filename):
+    """
+    Purges a document that no longer exists on disk, with everything derived from it.
+    Returns the IDs of the documents that cited it, whose references are pending again.
+    """
+    citing = []
+    with transaction() as conn:
+        c = conn.cursor()
+        c.execute("SELECT id FROM docs WHERE filename=?", (filename,))
+        row = c.fetchone()
+        if row:
+            doc_id = row[0]
+            c.execute("DELETE FROM dependencies WHERE child_doc_id=?", (doc_id,))
+            _unindex_rules(conn, "doc_id=?", (doc_id,))
+            c.execute("DELETE FROM rules WHERE doc_id=?", (doc_id,))
+            c.execute("DELETE FROM doc_keys WHERE doc_id=?", (doc_id,))
+            c.execute("DELETE FROM doc_numbers WHERE doc_id=?", (doc_id,))
+            _unindex_sections(conn, doc_id)
+            c.execute("DELETE FROM sections WHERE doc_id=?", (doc_id,))
+            invalidate_audit_cache(doc_id)
+            c.execute("DELETE FROM audit_results WHERE child_doc_id=? OR parent_doc_id=?", (doc_id, doc_id))
+            _unindex_document(conn, doc_id)
+            _delete_chunks(conn, doc_id)
+            # References from other documents become pending again so they can be re-resolved
+            citing = [child_id for child_id, in c.execute(CITING_DOCS_QUERY, (doc_id,))]
+            c.execute(RESET_CITATIONS_QUERY, (doc_id,))
+            _refresh_ancestors(conn, [doc_id])
+            c.execute("DELETE FROM docs WHERE id=?", (doc_id,))
+        c.execute("DELETE FROM file_manifest WHERE filename=?", (filename,))
+        _bump_generation(conn)
+    return citing
+
+# Hot queries: the statements the functions above run, so a changed query is checked as it runs.
+# check_query_plans fails if any of them stops using an index and scans a whole table.
+HOT_QUERIES = {
+    "add_dependency": DEPENDENCY_BY_REF_QUERY,
+    "get_rules_for_doc": RULES_FOR_DOC_QUERY,
+    "get_manifest_entry": MANIFEST_ENTRY_QUERY,
+    "get_running_scan_job": RUNNING_SCAN_JOB_QUERY,
+    "get_parent_docs": PARENT_DOCS_QUERY,
+    "get_ancestor_docs": ANCESTOR_DOCS_QUERY,
+    "get_doc_by_id": DOC_BY_ID_QUERY,
+    "get_doc_content": DOC_CHUNKS_QUERY,
+    "get_blob_text": BLOB_QUERY,
+    "delete_chunks": DELETE_UNUSED_BLOB_QUERY,
+    "get_content_range": CONTENT_RANGE_QUERY,
+    "get_sections": SECTIONS_QUERY,
+    "get_section_content": SECTION_OFFSETS_QUERY,
+    "get_doc_hash": DOC_HASH_QUERY,
+    "get_audit_cache": AUDIT_CACHE_QUERY,
+    "invalidate_audit_cache": INVALIDATE_AUDIT_CACHE_QUERY,
+    "replace_doc_keys": DELETE_DOC_KEYS_QUERY,
+    # With doc_ids (watch mode): the touched documents' dependencies, found without a scan
+    **{f"resolve_dependencies_{kind}_{step}": sql
+       for kind, statements in zip(("key", "number"), _resolve_statements(1))
+       for step, sql in zip(("children", "update"), statements)},
+    "remove_document_citing": CITING_DOCS_QUERY,
+    "remove_document_reset": RESET_CITATIONS_QUERY,
+    "refresh_ancestors": REFRESH_ANCESTORS_QUERY,
+    "get_dependencies_graph_nodes": NEIGHBORHOOD_NODES_QUERY,
+    "get_dependencies_graph_edges": NEIGHBORHOOD_EDGES_QUERY,
+}
+
+def check_query_plans():
+    """
+    Runs EXPLAIN QUERY PLAN on every hot query and returns [(query name, plan step)] for
+    each step that scans a whole table (no index, or a whole index); an empty list means every
+    plan is fine. Only scans of CTEs, temporary tables and virtual (full-text) tables are expected.
+    """
+    conn = get_connection()
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS ancestors_seed (doc_id INTEGER PRIMARY KEY)")
+    expected = {name for name, in conn.execute("SELECT name FROM sqlite_temp_master WHERE type='table'")}
+    expected |= {name for name, in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND sql LIKE 'CREATE VIRTUAL TABLE%'")}
+    problems = []
+    for name, sql in HOT_QUERIES.items():
+        ctes = set(re.findall(r"(\w+)\s*(?:\([\w\s,]*\))?\s+AS\s*\(", sql, re.IGNORECASE))
+        # Plans name a table by its alias when it has one (e.g. "SCAN d" for "dependencies d")
+        aliases = dict((alias, table) for table, alias in
+                       re.findall(r"\b(?:FROM|JOIN)\s+(\w+)\s+(?:AS\s+)?(\w+)", sql, re.IGNORECASE))
+        for _, _, _, detail in conn.execute("EXPLAIN QUERY PLAN " + sql, (None,) * sql.count("?")):
+            scanned = re.match(r"SCAN (?:TABLE )?(\w+)", detail)
+            if not scanned or detail.startswith("SCAN CONSTANT ROW") or "VIRTUAL TABLE" in detail:
+                continue
+            if scanned.group(1) not in ctes and aliases.get(scanned.group(1), scanned.group(1)) not in expected:
+                problems.append((name, detail))
+    return problems
+
+if __name__ == "__main__":
+    # One-shot maintenance commands, e.g.: python database.py compact
+    import sys
+    if sys.argv[1:] == ["compact"]:
+        init_db()
+        print(f"Removed {compact_rules()} duplicated rules.")
+    elif sys.argv[1:] == ["check-plans"]:
+        # Query plan regression check: exits with status 1 if a hot query does a full table scan
+        init_db()
+        problems = check_query_plans()
+        for name, detail in problems:
+            print(f"{name}: {detail}")
+        print(f"{len(HOT_QUERIES) - len({name for name, _ in problems})}/{len(HOT_QUERIES)} hot queries use indexes.")
+        sys.exit(1 if problems else 0)
+    elif sys.argv[1:] == ["compress"]:
+        init_db()
+        # Size on disk of the whole database (with its write-ahead log), not just of the text
+        def file_size():
+            return sum(os.path.getsize(path) for path in (DB_PATH, DB_PATH + "-wal") if os.path.exists(path))
+        size_before = file_size()
+        converted = compress_documents()
+        get_connection().execute("VACUUM")
+        get_connection().execute("PRAGMA wal_checkpoint(TRUNCATE)")  # VACUUM went to the WAL
+        print(f"Compressed the text of {converted} documents ({CONTENT_CODEC}); "
+              f"database file {size_before / 1024:.0f} KB -> {file_size() / 1024:.0f} KB.")
+    else:
+        print("Usage: python database.py compact | check-plans | compress")
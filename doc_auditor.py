@@ -0,0 +1,242 @@
+"""
+Command line entry point for headless (e.g. nightly) runs.
+
+Usage:
+    python -m doc_auditor audit --all [--ancestors] [--scan] [--workers N] [--csv FILE] [--jsonl FILE]
+    python -m doc_auditor audit FILENAME [FILENAME ...]
+    python -m doc_auditor watch [--debounce SECONDS] [--poll SECONDS]
+"""
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import database
+import jobs
+import processor
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags  # Optional (Linux only): pip install inotify_simple
+except ImportError:
+    INotify = None
+
+# Columns of the CSV report (and keys of each JSONL record)
+REPORT_FIELDS = ["child", "parent", "position", "rule_type", "status", "evidence_start", "evidence_end", "rule_text"]
+
+def _init_audit_worker(db_path):
+    database.DB_PATH = db_path
+
+def _audit_child(child_doc_id, ancestors=False):
+    """
+    Audits one child against all its resolved parents (or all its ancestors) without writing to the DB.
+    Returns (child_doc_id, report, new audit cache entries, number of cache hits).
+    """
+    hits = processor.AUDIT_CACHE_STATS["hits"]
+    pending_cache = []
+    parents = database.get_ancestor_docs(child_doc_id) if ancestors else database.get_parent_docs(child_doc_id)
+    report = processor.audit_against_parents(child_doc_id, parents, pending_cache)
+    return child_doc_id, report, pending_cache, processor.AUDIT_CACHE_STATS["hits"] - hits
+
+def run_audit(doc_ids, workers=None, csv_path=None, jsonl_path=None, ancestors=False):
+    """
+    Audits every child in doc_ids (against all its ancestors with ancestors=True) and streams
+    the results, as they arrive, into the audit_results table and the optional CSV/JSONL files.
+    With workers > 1 the audits run in a process pool; workers only read (they start with
+    "spawn" so none inherits this process's SQLite connection) and this process is the
+    single DB writer. Returns a dict of counts and the elapsed seconds.
+    """
+    names = dict(database.get_all_docs())
+    stats = {"documents": 0, "pairs": 0, "rules": 0, "cache_hits": 0, "statuses": Counter()}
+    start = time.perf_counter()
+
+    csv_file = open(csv_path, "w", newline="", encoding="utf-8") if csv_path else None
+    jsonl_file = open(jsonl_path, "w", encoding="utf-8") if jsonl_path else None
+    csv_writer = csv.DictWriter(csv_file, fieldnames=REPORT_FIELDS) if csv_file else None
+    if csv_writer:
+        csv_writer.writeheader()
+
+    executor = None
+    if workers and workers > 1 and len(doc_ids) > 1:
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                       initializer=_init_audit_worker, initargs=(database.DB_PATH,))
+    try:
+        if executor:
+            chunksize = max(1, len(doc_ids) // (workers * 4))
+            results = executor.map(_audit_child, doc_ids, repeat(ancestors), chunksize=chunksize)
+        else:
+            results = map(_audit_child, doc_ids, repeat(ancestors))
+
+        for child_doc_id, report, pending_cache, cache_hits in results:
+            with database.transaction():
+                for entry in pending_cache:
+                    database.save_audit_cache(*entry)
+                database.replace_audit_results(child_doc_id, report)
+
+            stats["documents"] += 1
+            stats["pairs"] += len(report)
+            stats["cache_hits"] += cache_hits
+            for p_id, p_filename, rules in report:
+                stats["rules"] += len(rules)
+                for position, (rule_text, rule_type, status, evidence) in enumerate(rules):
+                    stats["statuses"][status] += 1
+                    record = {
+                        "child": names.get(child_doc_id), "parent": p_filename, "position": position,
+                        "rule_type": rule_type, "status": status,
+                        "evidence_start": evidence[0] if evidence else None,
+                        "evidence_end": evidence[1] if evidence else None,
+                        "rule_text": rule_text,
+                    }
+                    if csv_writer:
+                        csv_writer.writerow(record)
+                    if jsonl_file:
+                        jsonl_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+    finally:
+        if executor:
+            executor.shutdown()
+        for f in (csv_file, jsonl_file):
+            if f:
+                f.close()
+
+    stats["seconds"] = time.perf_counter() - start
+    return stats
+
+def print_audit_stats(stats):
+    seconds = max(stats["seconds"], 1e-9)
+    print(f"Audited {stats['documents']} documents against {stats['pairs']} parents "
+          f"({stats['rules']} rules) in {stats['seconds']:.2f} s")
+    print(f"Throughput: {stats['documents'] / seconds:.1f} documents/s, {stats['rules'] / seconds:.0f} rules/s")
+    print(f"Audit cache: {stats['cache_hits']} of {stats['pairs']} parents reused")
+    print("Verdicts: " + ", ".join(f"{status} {count}" for status, count in sorted(stats["statuses"].items())))
+
+def cmd_audit(args):
+    database.init_db()
+    if args.scan:
+        scan_stats = jobs.run_scan(workers=args.workers)
+        if scan_stats is None:
+            print("Another scan is running; try again when it finishes.", file=sys.stderr)
+            return 1
+        print(f"Scan: {scan_stats}")
+
+    if args.all:
+        doc_ids = database.get_audited_children()
+    else:
+        by_name = {filename: doc_id for doc_id, filename in database.get_all_docs()}
+        unknown = [name for name in args.filenames if name not in by_name]
+        if unknown:
+            print(f"Unknown documents: {', '.join(unknown)}", file=sys.stderr)
+            return 1
+        doc_ids = [by_name[name] for name in args.filenames]
+
+    stats = run_audit(doc_ids, workers=args.workers, csv_path=args.csv, jsonl_path=args.jsonl, ancestors=args.ancestors)
+    print_audit_stats(stats)
+    return 0
+
+def _poll_changes(directory, interval):
+    """Yields the .txt names whose size or mtime changed (or that appeared or vanished) every interval seconds"""
+    def snapshot():
+        files = {}
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.endswith(".txt") and entry.is_file():
+                    file_stat = entry.stat()
+                    files[entry.name] = (file_stat.st_size, file_stat.st_mtime_ns)
+        return files
+
+    previous = snapshot()
+    while True:
+        time.sleep(interval)
+        current = snapshot()
+        yield {name for name in previous.keys() | current.keys() if previous.get(name) != current.get(name)}
+        previous = current
+
+def _inotify_changes(directory, interval):
+    """Yields the .txt names with inotify events, at most every interval seconds (an empty set when idle)"""
+    inotify = INotify()
+    mask = (inotify_flags.CLOSE_WRITE | inotify_flags.MODIFY | inotify_flags.CREATE | inotify_flags.DELETE
+            | inotify_flags.MOVED_TO | inotify_flags.MOVED_FROM)
+    inotify.add_watch(directory, mask)
+    try:
+        while True:
+            yield {event.name for event in inotify.read(timeout=int(interval * 1000)) if event.name.endswith(".txt")}
+    finally:
+        inotify.close()
+
+def iter_change_batches(directory, debounce=2.0, poll=2.0, max_wait=30.0):
+    """
+    Yields sets of touched .txt filenames in directory, debounced: a batch is released once no
+    new change arrived for debounce seconds (or after max_wait seconds of continuous changes, so
+    a busy directory still gets ingested). Uses inotify when inotify_simple is installed, and a
+    stat poll of the directory every poll seconds otherwise.
+    """
+    changes = _inotify_changes(directory, min(debounce, poll)) if INotify else _poll_changes(directory, poll)
+    batch = set()
+    first = last = None
+    for changed in changes:
+        now = time.monotonic()
+        if changed:
+            batch |= changed
+            first = first or now
+            last = now
+        if batch and (now - last >= debounce or now - first >= max_wait):
+            yield batch
+            batch = set()
+            first = last = None
+
+def cmd_watch(args):
+    database.init_db()
+    directory = processor.DOCS_DIR
+    # Catch up with what changed while nobody was watching
+    stats = jobs.run_scan(workers=args.workers)
+    print(f"Initial scan: {stats}" if stats is not None else "A scan is already running; watching anyway.")
+    print(f"Watching {directory} ({'inotify' if INotify else f'polling every {args.poll} s'}); Ctrl+C to stop")
+
+    try:
+        for batch in iter_change_batches(directory, debounce=args.debounce, poll=args.poll):
+            try:
+                stats = jobs.run_scan(filenames=batch)
+                while stats is None:
+                    # Another scan (e.g. from the app) is running; changes keep queuing meanwhile
+                    time.sleep(args.debounce)
+                    stats = jobs.run_scan(filenames=batch)
+            except RuntimeError as error:
+                print(error, file=sys.stderr)
+                continue
+            print(f"{time.strftime('%H:%M:%S')} {', '.join(sorted(batch))}: {stats}")
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m doc_auditor", description="Doc Auditor headless commands")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    audit = commands.add_parser("audit", help="audit documents against the rules of the documents they cite")
+    targets = audit.add_mutually_exclusive_group(required=True)
+    targets.add_argument("--all", action="store_true", help="every document with at least one resolved parent")
+    targets.add_argument("filenames", nargs="*", default=[], help="documents to audit, by filename")
+    audit.add_argument("--ancestors", action="store_true",
+                       help="also check the rules of every ancestor (parents of parents, ...), not only direct parents")
+    audit.add_argument("--scan", action="store_true", help="scan the documentos directory first")
+    audit.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes (default: CPU count)")
+    audit.add_argument("--csv", help="also write the results to this CSV file")
+    audit.add_argument("--jsonl", help="also write the results to this JSON Lines file")
+    audit.set_defaults(func=cmd_audit)
+
+    watch = commands.add_parser("watch", help="keep the DB in sync with the documentos directory as files change")
+    watch.add_argument("--debounce", type=float, default=2.0,
+                       help="seconds without changes before a batch is ingested (default: 2)")
+    watch.add_argument("--poll", type=float, default=2.0,
+                       help="seconds between directory polls when inotify_simple is not installed (default: 2)")
+    watch.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes for the initial scan")
+    watch.set_defaults(func=cmd_watch)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,90 @@
+"""
+Opt-in timing of the hot paths in database.py and processor.py.
+
+Functions decorated with @timed record their call count, cumulative and p95 latency and the
+rows they touched (rows returned plus rows written through SQLite). Recording is off by
+default: a disabled call costs one global lookup and a branch. Enable it with enable() or
+by starting the app with DOC_AUDITOR_PROFILE=1.
+"""
+import cProfile
+import functools
+import io
+import marshal
+import os
+import pstats
+import threading
+import time
+from collections import deque
+
+ENABLED = os.environ.get("DOC_AUDITOR_PROFILE") == "1"
+
+# Latencies kept per function for the p95 (the most recent ones)
+MAX_SAMPLES = 1000
+
+_stats = {}
+_lock = threading.Lock()
+_changes_counter = None
+
+def enable(on=True):
+    global ENABLED
+    ENABLED = on
+
+def set_changes_counter(counter):
+    """Registers a callable returning the rows written so far (e.g. a connection's total_changes)"""
+    global _changes_counter
+    _changes_counter = counter
+
+def timed(func):
+    """Records calls of func while instrumentation is enabled (see the module docstring)"""
+    name = f"{func.__module__}.{func.__name__}"
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not ENABLED:
+            return func(*args, **kwargs)
+        changes = _changes_counter() if _changes_counter else 0
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+        rows = len(result) if isinstance(result, list) else 0
+        if _changes_counter:
+            rows += max(0, _changes_counter() - changes)  # The connection may have been reopened
+        with _lock:
+            entry = _stats.get(name)
+            if entry is None:
+                entry = _stats[name] = {"calls": 0, "seconds": 0.0, "rows": 0, "samples": deque(maxlen=MAX_SAMPLES)}
+            entry["calls"] += 1
+            entry["seconds"] += elapsed
+            entry["rows"] += rows
+            entry["samples"].append(elapsed)
+        return result
+    return wrapper
+
+def get_stats():
+    """[(function, calls, cumulative seconds, p95 seconds, rows touched)], most expensive first"""
+    with _lock:
+        rows = []
+        for name, entry in _stats.items():
+            samples = sorted(entry["samples"])
+            p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))] if samples else 0.0
+            rows.append((name, entry["calls"], entry["seconds"], p95, entry["rows"]))
+    return sorted(rows, key=lambda row: -row[2])
+
+def reset():
+    with _lock:
+        _stats.clear()
+
+def profile_call(func, *args, **kwargs):
+    """
+    Runs func under cProfile. Returns (result, profile dump in pstats format, text summary of the
+    top 25 functions by cumulative time); the dump opens with pstats or snakeviz.
+    """
+    profiler = cProfile.Profile()
+    result = profiler.runcall(func, *args, **kwargs)
+    summary = io.StringIO()
+    stats = pstats.Stats(profiler, stream=summary)
+    stats.sort_stats("cumulative").print_stats(25)
+    # Same bytes as Stats.dump_stats() writes to a .prof file
+    return result, marshal.dumps(stats.stats), summary.getvalue()
@@ -0,0 +1,123 @@
+"""
+Background scan jobs: scan_directory runs in a thread of this process, its progress goes to the
+scan_jobs table and any session (or process) can poll it with get_scan_progress.
+The scan_jobs table allows a single running job, so concurrent triggers don't start a second scan.
+"""
+import os
+import threading
+import time
+import traceback
+import uuid
+import database
+import instrumentation
+import processor
+
+# A running job whose progress hasn't moved for this long is considered dead
+STALE_JOB_SECONDS = 3600
+
+# Identifies this process in scan_jobs: a pid can be reused by a later process (e.g. pid 1 in a restarted container)
+PROCESS_TOKEN = uuid.uuid4().hex
+
+# Ids of the jobs this process is running
+_live_jobs = set()
+
+def _is_stale(job):
+    """Whether a job left "running" belongs to a process that died mid-scan"""
+    if time.time() - job["updated_at"] > STALE_JOB_SECONDS:
+        return True
+    if job["pid"] == os.getpid():
+        # Our pid: alive only if it is one of our jobs, not one of a previous process with the same pid
+        return job["process_token"] != PROCESS_TOKEN or job["id"] not in _live_jobs
+    if os.name == "posix":
+        try:
+            os.kill(job["pid"], 0)  # Signal 0: only checks that the process exists
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+    return False
+
+def _claim_scan_job():
+    """Registers a new running job and returns its id; None if a live scan is already running"""
+    running = database.get_running_scan_job()
+    if running and _is_stale(running):
+        database.finish_scan_job(running["id"], "failed", time.time(), error="The scanning process exited mid-scan")
+    job_id = database.create_scan_job(os.getpid(), PROCESS_TOKEN, time.time())
+    if job_id is not None:
+        _live_jobs.add(job_id)
+    return job_id
+
+# cProfile result of the last profiled job run by this process: job id -> (pstats dump, text summary).
+# Only the last one is kept, since each dump holds the stats of a whole scan
+SCAN_PROFILES = {}
+
+def _run_scan_job(job_id, workers, profile=False, filenames=None):
+    def progress(files_done, files_total, bytes_done, bytes_total, filename):
+        if database.update_scan_job_progress(job_id, files_done, files_total, bytes_done, bytes_total,
+                                             filename, time.time()):
+            raise processor.ScanCancelled()
+
+    try:
+        if filenames is not None:
+            stats = processor.ingest_files(filenames, progress=progress)
+        elif profile:
+            stats, dump, summary = instrumentation.profile_call(processor.scan_directory, workers=workers, progress=progress)
+            SCAN_PROFILES.clear()
+            SCAN_PROFILES[job_id] = (dump, summary)
+        else:
+            stats = processor.scan_directory(workers=workers, progress=progress)
+        database.finish_scan_job(job_id, "cancelled" if stats["cancelled"] else "done", time.time(), stats)
+    except Exception:
+        database.finish_scan_job(job_id, "failed", time.time(), error=traceback.format_exc(limit=5))
+    finally:
+        _live_jobs.discard(job_id)
+        database.close_connection()
+
+def start_scan(workers=None, profile=False):
+    """
+    Starts a scan in a background thread (under cProfile with profile=True, see SCAN_PROFILES).
+    Returns the job id, or None when another scan is already running (in this or any other process).
+    """
+    job_id = _claim_scan_job()
+    if job_id is not None:
+        threading.Thread(target=_run_scan_job, args=(job_id, workers, profile),
+                         name=f"scan-job-{job_id}", daemon=True).start()
+    return job_id
+
+def run_scan(workers=None, filenames=None):
+    """
+    Runs a scan in the calling thread, registered as a job; with filenames, only those files are
+    ingested (processor.ingest_files). Returns its result, or None if another scan is running;
+    raises RuntimeError if the scan failed.
+    """
+    job_id = _claim_scan_job()
+    if job_id is None:
+        return None
+    _run_scan_job(job_id, workers, filenames=filenames)
+    job = database.get_scan_job(job_id)
+    if job["status"] == "failed":
+        raise RuntimeError(f"Scan job {job_id} failed:\n{job['error']}")
+    return job["stats"]
+
+def cancel_scan(job_id):
+    """Asks a running job to stop; it does after the file in progress"""
+    database.request_scan_cancel(job_id)
+
+def get_scan_progress(job_id=None):
+    """
+    Polling endpoint: the job (by default the latest one) as a dict with its status, counts
+    and current file, plus elapsed seconds, throughput (files/s, bytes/s) and ETA in seconds
+    (from the byte rate; None until it is known). None if no scan was ever started.
+    """
+    job = database.get_scan_job(job_id)
+    if job is None:
+        return None
+    end = job["finished_at"] or time.time()
+    elapsed = max(end - job["started_at"], 1e-6)
+    job["elapsed"] = elapsed
+    job["files_per_second"] = job["files_done"] / elapsed
+    job["bytes_per_second"] = job["bytes_done"] / elapsed
+    job["eta"] = None
+    if job["status"] == "running" and job["bytes_done"] and job["bytes_total"]:
+        job["eta"] = (job["bytes_total"] - job["bytes_done"]) / job["bytes_per_second"]
+    return job
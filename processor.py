@@ -1,239 +1,948 @@
+import io
 import os
 import re
+import hashlib
+import heapq
+import multiprocessing
+from collections import Counter, deque
+from functools import lru_cache
+from itertools import chain, repeat
+from concurrent.futures import ProcessPoolExecutor
 import database
+from instrumentation import timed
 
 # Use path relative to this script file to ensure it works regardless of CWD
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DOCS_DIR = os.path.join(BASE_DIR, "documentos")
 
-# Regex patterns for dependencies
-DEP_PATTERNS = [
-    r"(Ley\s+N[°ºo]?\s*\.?\s*\d+)",      # Ley N° 12345
-    r"(Decreto\s+Supremo\s+N[°ºo]?\s*\.?\s*\d+[-–]\d+[-–]\w+)", # DS N° 001-2020-PCM
-    r"(Resolución\s+Ministerial\s+N[°ºo]?\s*\.?\s*\d+[-–]\d+[-–]\w+)",
-    r"(Decreto\s+Legislativo\s+N[°ºo]?\s*\.?\s*\d+)"
-]
+# Files this large are ingested by streaming them instead of reading them whole
+STREAM_THRESHOLD_BYTES = 32 * 1024 * 1024
+# Streamed content is stored in chunks of about this many characters (always whole lines)
+CONTENT_CHUNK_CHARS = 256 * 1024
+# Streamed sections longer than this are summarized from their beginning only
+SUMMARY_WINDOW_CHARS = 200000
 
-# Keywords for rules
-OBLIGATION_KEYWORDS = ["debe", "deberá", "tiene que", "es obligatorio", "corresponde a"]
-PROHIBITION_KEYWORDS = ["prohibido", "no podrá", "no se permite", "queda prohibido"]
+# Single compiled pattern for dependencies (one scan of the text finds every citation type)
+# e.g. "Ley N° 12345", "Decreto Supremo Nº 001-2020-PCM", "Resolución Ministerial N. 132-2024-PCM"
+CITATION_PATTERN = re.compile(
+    # The lookahead lets the engine reject most positions on their first character
+    r"(?=[LDRldr])(?P<type>Ley|Decreto\s+(?:Supremo|Legislativo)|Resoluci[oó]n\s+Ministerial)"
+    r"\s+N[°ºo]?\s*\.?\s*(?P<number>\d+)"
+    r"(?:\s*[-–]\s*(?P<year>\d{2,4})\s*[-–]\s*(?P<issuer>[A-Za-z]\w*))?",
+    re.IGNORECASE
+)
+
+# Citation type -> (key prefix, display name, needs year and issuer)
+CITATION_TYPES = {
+    "ley": ("LEY", "Ley", False),
+    "decreto supremo": ("DS", "Decreto Supremo", True),
+    "resolucion ministerial": ("RM", "Resolución Ministerial", True),
+    "decreto legislativo": ("DLEG", "Decreto Legislativo", False),
+}
+
+CITATION_PREFIXES = {prefix: (display, needs_year) for prefix, display, needs_year in CITATION_TYPES.values()}
+
+# A citation at the very start of a line (ignoring markdown marks), used to identify a document by its header
+HEADER_CITATION_PATTERN = re.compile(r"[#*\s]*" + CITATION_PATTERN.pattern, re.IGNORECASE)
+
+# Type token in filenames, e.g. LEY, DLEG, DS115
+FILENAME_TYPE_PATTERN = re.compile(r"(LEY|DLEG|DS|RM)(\d*)")
+
+# Bump whenever match_rules changes its verdicts, so cached audits are recomputed
+COMPLIANCE_VERSION = 3
+
+# Audit cache counters for this process (shown in the sidebar)
+AUDIT_CACHE_STATS = {"hits": 0, "misses": 0}
+
+# Regex for potential headers: Uppercase lines or specific keywords
+SECTION_HEADER_PATTERN = re.compile(r'^(TÍTULO|TITULO|CAPÍTULO|CAPITULO|SECCIÓN|SECCION|ARTÍCULO|ARTICULO)\s', re.IGNORECASE)
+
+# Tokenization used by the summarizer
+WORD_PATTERN = re.compile(r'\w+')
+SENTENCE_SPLIT_PATTERN = re.compile(r'(?<=[.!?])\s+')
+
+# Rule extraction works on sentences and numbered clauses rebuilt from hard-wrapped lines.
+# A line starting like this opens a new clause: "Artículo 5", "Artículo N° 5", "5.1.2", "4.", "1)",
+# literals ("a)", "a1)", "iv)"), bullets and table rows
+CLAUSE_START_PATTERN = re.compile(
+    r"(?:\*\*)?(?:art[íi]culo\s+(?:n[°º.]*\s*)?\d+|\d+(?:\.\d+)+\.?\s|\d+[.)]\s|[a-z]\d*\)\s|[ivxl]+[.)]\s|[-•·*]\s|\|)",
+    re.IGNORECASE)
+# Sentence end inside a line: ., ! or ? and a capitalized word (so "Art. 5" or "N° 5. 6" don't split)
+SENTENCE_END_PATTERN = re.compile(r'[.!?](\s+)(?=["“(¿¡]?[A-ZÁÉÍÓÚÑ])')
+ABBREVIATION_PATTERN = re.compile(r'(?:^|\W)(\w+)\.$')
+ABBREVIATIONS = {"art", "arts", "inc", "núm", "num", "pág", "pag", "sr", "sra", "srta", "dr", "dra", "ing", "lic", "ej"}
+# Longer clauses (run-on text) are cut, which bounds the segmenter's memory
+MAX_CLAUSE_CHARS = 2000
+
+# Word characters, as the FTS5 unicode61 tokenizer sees them
+INDEX_TOKEN_PATTERN = re.compile(r'[^\W_]+')
+
+# Keywords for rules, matched as whole words ("debe" does not fire on "deberes")
+OBLIGATION_KEYWORDS = ["debe", "deben", "deberá", "deberán", "debería", "deberían", "debiendo", "tiene que", "tienen que",
+                       "es obligatorio", "es obligatoria", "corresponde a", "corresponde al"]
+PROHIBITION_KEYWORDS = ["prohibido", "prohibida", "prohibidos", "prohibidas", "no podrá", "no podrán",
+                        "no se permite", "queda prohibido"]
+
+# Extra domain triggers ("[TYPE]" headers, one phrase per line), added to the keywords above
+RULE_TRIGGERS_FILE = os.path.join(BASE_DIR, "rule_triggers.txt")
 
 STOP_WORDS = {"el", "la", "los", "las", "un", "una", "de", "del", "a", "ante", "bajo", "cabe", "con", "contra", "de", "desde", "en", "entre", "hacia", "hasta", "para", "por", "según", "sin", "sobe", "tras", "y", "o", "que", "se", "su", "sus", "es", "son", "no", "lo", "al", "como", "más", "pero", "si", "mi", "me", "te", "ti", "nos"}
+# The same, as terms of the full-text index ("según" -> "segun")
+STOP_TERMS = frozenset(database.tokenize(" ".join(STOP_WORDS)))
+
+def load_rule_triggers(path=RULE_TRIGGERS_FILE):
+    """
+    {rule_type: [phrase, ...]} in precedence order: the built-in keywords plus the phrases of the
+    trigger file, if it exists. A line matching several types gets the first one (prohibitions win).
+    """
+    triggers = {"PROHIBITION": list(PROHIBITION_KEYWORDS), "OBLIGATION": list(OBLIGATION_KEYWORDS)}
+    if not os.path.exists(path):
+        return triggers
+    rule_type = None
+    with open(path, "r", encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            line = " ".join(line.split("#", 1)[0].split())
+            if not line:
+                continue
+            if line.startswith("[") and line.endswith("]"):
+                rule_type = line[1:-1].strip().upper()
+                triggers.setdefault(rule_type, [])
+            elif rule_type is None:
+                raise ValueError(f"{path}:{number}: trigger '{line}' is not under a [TYPE] header")
+            else:
+                triggers[rule_type].append(line.lower())
+    return triggers
+
+def _trie_pattern(phrases):
+    """
+    Regex alternation of phrases factored by common prefixes, so each branch starts with a
+    different character and the matcher walks one path like a keyword automaton: the cost
+    per position grows with the phrase length, not with the number of phrases.
+    """
+    trie = {}
+    for phrase in phrases:
+        node = trie
+        for char in phrase:
+            node = node.setdefault(char, {})
+        node[None] = None  # End of a phrase
+
+    def build(node):
+        ends = None in node
+        branches = [(r"\s+" if char == " " else re.escape(char)) + build(child)
+                    for char, child in sorted((item for item in node.items() if item[0] is not None))]
+        if not branches:
+            return ""
+        body = "|".join(branches)
+        if len(branches) > 1 or (ends and len(body) > 1):
+            body = "(?:" + body + ")"
+        return body + "?" if ends else body
+    return build(trie)
+
+def compile_rule_triggers(triggers):
+    """
+    One regex for all the rule triggers, a named group per rule type and whole-word matches only.
+    Returns (pattern, [rule_type of group t0, t1, ...]).
+    """
+    types = [rule_type for rule_type, phrases in triggers.items() if phrases]
+    groups = "|".join(f"(?P<t{i}>{_trie_pattern(triggers[rule_type])})" for i, rule_type in enumerate(types))
+    # Leading class of first letters: positions that can't start a trigger are skipped cheaply
+    firsts = "".join(sorted({re.escape(phrase[0]) for phrases in triggers.values() for phrase in phrases}))
+    return re.compile(rf"(?=[{firsts}])(?<!\w)(?:{groups})(?!\w)", re.IGNORECASE), types
 
-def scan_directory():
-    """Scans the 'documentos' directory, updates DB, and processes docs."""
+RULE_TRIGGERS = load_rule_triggers()
+RULE_TRIGGER_PATTERN, RULE_TRIGGER_TYPES = compile_rule_triggers(RULE_TRIGGERS)
+# Bump when rule segmentation changes (2: sentences/clauses instead of physical lines)
+RULE_EXTRACTION_VERSION = 2
+# Stored after each scan; when the triggers or the version change, every document's rules are re-extracted
+RULE_TRIGGERS_FINGERPRINT = int(hashlib.sha256(repr((RULE_EXTRACTION_VERSION, RULE_TRIGGERS)).encode("utf-8")).hexdigest()[:15], 16)
+
+@timed
+def scan_directory(workers=None, progress=None):
+    """
+    Scans the 'documentos' directory, updates DB, and processes docs.
+    Only new or modified files are reprocessed (based on the file manifest),
+    and documents whose file was deleted are purged.
+    With workers > 1, reading and extraction run in a process pool while this
+    process stays the single DB writer; the result is the same as the serial path.
+    progress(files_done, files_total, bytes_done, bytes_total, filename) is called once the
+    work is known and after every file; it may raise ScanCancelled to stop between files
+    (what was stored so far stays, and is resolved).
+    Returns a dict with the number of files added, updated, skipped and removed, and whether
+    the scan was cancelled.
+    """
+    stats = {"added": 0, "updated": 0, "skipped": 0, "removed": 0, "cancelled": False}
     if not os.path.exists(DOCS_DIR):
         print(f"Directory {DOCS_DIR} not found.")
-        return
+        return stats
 
-    # 1. Load all files
+    manifest = database.get_manifest()
+    # Rule extraction (triggers or segmentation) changed since the last scan: no file counts as unchanged
+    rules_stale = database.get_meta("rule_triggers") != RULE_TRIGGERS_FINGERPRINT
+    if rules_stale:
+        manifest = {filename: (doc_id, size, None, None) for filename, (doc_id, size, _, _) in manifest.items()}
+    seen = set()
+    pending = []
+    streamed = []
+
+    # 1. Find new or modified files
     for filename in os.listdir(DOCS_DIR):
         if filename.endswith(".txt"):
-            filepath = os.path.join(DOCS_DIR, filename)
-            with open(filepath, "r", encoding="utf-8", errors="ignore") as f:
-                content = f.read()
-            
-            # Save to DB
-            doc_id = database.add_document(filename, content)
-            
-            # 2. Extract Dependencies
-            extract_dependencies_from_text(doc_id, content)
+            seen.add(filename)
+            file_stat = os.stat(os.path.join(DOCS_DIR, filename))
+            entry = manifest.get(filename)  # (doc_id, size, mtime_ns, content_hash)
+
+            # Same size and mtime: assume unchanged without reading it
+            if entry and entry[1] == file_stat.st_size and entry[2] == file_stat.st_mtime_ns:
+                stats["skipped"] += 1
+                continue
+
+            if file_stat.st_size >= STREAM_THRESHOLD_BYTES:
+                streamed.append((filename, file_stat, entry))
+            else:
+                pending.append((filename, file_stat, entry))
+
+    files_done = bytes_done = 0
+    files_total = len(pending) + len(streamed)
+    bytes_total = sum(file_stat.st_size for _, file_stat, _ in pending + streamed)
+    def report(filename=None, file_stat=None):
+        nonlocal files_done, bytes_done
+        if file_stat:
+            files_done += 1
+            bytes_done += file_stat.st_size
+        if progress:
+            progress(files_done, files_total, bytes_done, bytes_total, filename)
+
+    # 2. Read and parse them (in parallel if requested), storing results as they arrive
+    paths = [os.path.join(DOCS_DIR, filename) for filename, _, _ in pending]
+    known_hashes = [entry[3] if entry else None for _, _, entry in pending]
+    executor = None
+    if workers and workers > 1 and len(pending) > 1:
+        # "spawn": scans may run in a background thread, and forking a threaded process is unsafe
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    try:
+        report()
+        if executor:
+            chunksize = max(1, len(paths) // (workers * 4))
+            results = executor.map(_parse_file, paths, known_hashes, chunksize=chunksize)
+        else:
+            results = map(_parse_file, paths, known_hashes)
+
+        for (filename, file_stat, entry), parsed in zip(pending, results):
+            stats[_store_parsed(filename, file_stat, entry, parsed)] += 1
+            report(filename, file_stat)
+
+        # Very large files are streamed here, one at a time, to keep memory bounded
+        for filename, file_stat, entry in streamed:
+            stats[_ingest_streaming(filename, file_stat, entry)] += 1
+            report(filename, file_stat)
+    except ScanCancelled:
+        stats["cancelled"] = True
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+
+    # 3. Purge documents whose file was deleted
+    if not stats["cancelled"]:
+        known = set(manifest) | {filename for _, filename in database.get_all_docs()}
+        for filename in known - seen:
+            database.remove_document(filename)
+            stats["removed"] += 1
+
+    # 4. Resolve dependencies (link citation keys to IDs)
+    if stats["added"] or stats["updated"] or stats["removed"]:
+        database.resolve_dependencies()
+    if rules_stale and not stats["cancelled"]:
+        database.set_meta("rule_triggers", RULE_TRIGGERS_FINGERPRINT)
+
+    return stats
+
+@timed
+def ingest_files(filenames, progress=None):
+    """
+    Incremental counterpart of scan_directory for a known set of touched files (e.g. from a
+    directory watcher): each one is ingested if new or changed, or purged if it is gone, and
+    only the dependencies that these documents can affect are re-resolved. Nothing else in
+    the directory is listed or read. progress is as in scan_directory.
+    Returns the same stats dict as scan_directory.
+    """
+    stats = {"added": 0, "updated": 0, "skipped": 0, "removed": 0, "cancelled": False}
+    touched = []
+    # Documents citing a removed one: their references may resolve to another document now
+    citing = []
+    work = []
+    for filename in sorted(set(filenames)):
+        if not filename.endswith(".txt"):
+            continue
+        path = os.path.join(DOCS_DIR, filename)
+        entry = database.get_manifest_entry(filename)
+        if not os.path.isfile(path):
+            if entry:
+                citing += database.remove_document(filename)
+                stats["removed"] += 1
+            continue
+        work.append((filename, os.stat(path), entry))
+
+    bytes_total = sum(file_stat.st_size for _, file_stat, _ in work)
+    files_done = bytes_done = 0
+    try:
+        if progress:
+            progress(0, len(work), 0, bytes_total, None)
+        for filename, file_stat, entry in work:
+            if entry and entry[1] == file_stat.st_size and entry[2] == file_stat.st_mtime_ns:
+                outcome = "skipped"
+            elif file_stat.st_size >= STREAM_THRESHOLD_BYTES:
+                outcome = _ingest_streaming(filename, file_stat, entry)
+            else:
+                parsed = _parse_file(os.path.join(DOCS_DIR, filename), entry[3] if entry else None)
+                outcome = _store_parsed(filename, file_stat, entry, parsed)
+            stats[outcome] += 1
+            if outcome != "skipped":
+                touched.append(filename)
+            files_done += 1
+            bytes_done += file_stat.st_size
+            if progress:
+                progress(files_done, len(work), bytes_done, bytes_total, filename)
+    except ScanCancelled:
+        stats["cancelled"] = True
+
+    if touched or citing:
+        doc_ids = {database.get_manifest_entry(filename)[0] for filename in touched}
+        database.resolve_dependencies(sorted(doc_ids | set(citing)))
+    return stats
+
+def _store_parsed(filename, file_stat, entry, parsed):
+    """Stores a _parse_file result; returns "added", "updated" or "skipped" (same content)"""
+    content_hash = parsed["content_hash"]
+    # Touched but same content: only refresh the manifest
+    if entry and entry[3] == content_hash:
+        database.update_manifest(filename, entry[0], file_stat.st_size, file_stat.st_mtime_ns, content_hash)
+        return "skipped"
+
+    # Content, keys, dependencies, rules, sections and manifest entry are written as one unit of work
+    with database.transaction():
+        doc_id = database.add_document(filename, parsed["content"])
+        database.replace_doc_keys(doc_id, parsed["keys"])
+        database.replace_dependencies(doc_id, parsed["refs"])
+        database.replace_rules(doc_id, parsed["rules"])
+        structure = parsed["structure"]
+        database.replace_sections(doc_id, structure["general_summary"], structure["sections"])
+        database.update_manifest(filename, doc_id, file_stat.st_size, file_stat.st_mtime_ns, content_hash)
+    return "updated" if entry else "added"
+
+@timed
+def _parse_file(filepath, known_hash=None):
+    """
+    Reads a file and extracts everything stored at ingest time (pure CPU work, safe to run
+    in a worker process). Returns a dict with content, content_hash and, unless the content
+    hash equals known_hash, its identifying keys, dependencies, rules and structure.
+    """
+    with open(filepath, "r", encoding="utf-8", errors="ignore") as f:
+        content = f.read()
+    parsed = {"content": content, "content_hash": hashlib.sha256(content.encode("utf-8")).hexdigest()}
+    if parsed["content_hash"] == known_hash:
+        return parsed
+    keys = find_document_keys(os.path.basename(filepath), content)
+    parsed["keys"] = keys
+    parsed["refs"] = _external_citations(find_dependencies(content), keys)
+    parsed["rules"] = find_rules(content)
+    parsed["structure"] = analyze_document_structure(content)
+    return parsed
+
+class ScanCancelled(Exception):
+    """Raised by a scan_directory progress callback to stop the scan between files."""
+
+class _UnchangedContent(Exception):
+    """Raised to roll back a streaming ingest whose content hash turned out unchanged."""
+
+@timed
+def _ingest_streaming(filename, file_stat, entry):
+    """
+    Ingests a large file in a single pass over its lines: content goes to the DB in chunks
+    while hash, citations, rules, word counts and section bounds are computed from the
+    same stream, so memory is bounded by the chunk (and summary window) size, not the file.
+    Returns "added", "updated" or "skipped".
+    """
+    filepath = os.path.join(DOCS_DIR, filename)
+    hasher = hashlib.sha256()
+    word_freq = Counter()
+    citations = {}
+    rules = {}  # Rule text -> type, so a rule repeated throughout the file is held once
+    head = []  # First chunk, for the header keys and general summary
+
+    def collect_rule(text, start, end):
+        found = classify_rule(text)
+        if found:
+            rules.setdefault(text, found[0])
+    feed_clause = clause_segmenter(collect_rule)
+
+    try:
+        with open(filepath, "r", encoding="utf-8", errors="ignore") as f, database.transaction():
+            doc_id = database.add_document(filename, None)
+
+            def store_chunk(seq, start, chunk, previous_tail):
+                database.add_content_chunk(doc_id, seq, start, chunk)
+                hasher.update(chunk.encode("utf-8"))
+                word_freq.update(WORD_PATTERN.findall(chunk.lower()))
+                # Overlap with the previous chunk's tail so citations split across chunks are found
+                for citation in find_dependencies(previous_tail + chunk):
+                    citations.setdefault(citation["key"], citation)
+                if not head:
+                    head.append(chunk)
+
+            def tapped_lines():
+                # Feeds every line to the rule scanner and the chunk writer on its way to the section splitter
+                buffer = []
+                buffered = 0
+                seq = start = 0
+                tail = ""
+                for line in f:
+                    feed_clause(line)
+                    buffer.append(line)
+                    buffered += len(line)
+                    if buffered >= CONTENT_CHUNK_CHARS:
+                        chunk = "".join(buffer)
+                        store_chunk(seq, start, chunk, tail)
+                        seq, start, tail = seq + 1, start + len(chunk), chunk[-200:]
+                        buffer, buffered = [], 0
+                    yield line
+                if buffer or seq == 0:
+                    store_chunk(seq, start, "".join(buffer), tail)
+                feed_clause(None)
+
+            # Sections go to the DB as they are found; their summaries need the whole word count
+            database.replace_sections(doc_id, None, [])
+            for position, (title, start, end) in enumerate(iter_section_bounds(tapped_lines())):
+                database.add_section(doc_id, position, title, start, end)
+
+            content_hash = hasher.hexdigest()
+            if entry and entry[3] == content_hash:
+                raise _UnchangedContent()
+
+            head_text = head[0]
+            keys = find_document_keys(filename, head_text)
+            for word in STOP_WORDS:
+                del word_freq[word]
+            summaries = ((position, generate_summary(
+                              database.get_content_range(doc_id, start, min(end, start + SUMMARY_WINDOW_CHARS)),
+                              word_freq=word_freq))
+                         for position, _, start, end, _ in database.iter_sections(doc_id))
+
+            database.replace_doc_keys(doc_id, keys)
+            database.replace_dependencies(doc_id, _external_citations(
+                (cit for _, cit in sorted(citations.items())), keys))
+            database.replace_rules(doc_id, list(rules.items()))
+            database.set_section_summaries(doc_id, generate_summary(head_text[:5000], num_sentences=4), summaries)
+            database.update_manifest(filename, doc_id, file_stat.st_size, file_stat.st_mtime_ns, content_hash)
+    except _UnchangedContent:
+        # Touched but same content: only refresh the manifest
+        database.update_manifest(filename, entry[0], file_stat.st_size, file_stat.st_mtime_ns, entry[3])
+        return "skipped"
+    return "updated" if entry else "added"
+
+def parse_citation(match):
+    """
+    Turns a CITATION_PATTERN match into a structured citation:
+    {"type", "number", "year", "issuer", "key", "label"}, or None if it is incomplete.
+    The key is canonical, so "Ley N° 31814", "Ley Nº 31814" and "LEY N. 31814" share it.
+    """
+    type_name = " ".join(match.group("type").lower().replace("ó", "o").split())
+    prefix = CITATION_TYPES[type_name][0]
+    return make_citation(prefix, match.group("number"), match.group("year"), match.group("issuer"))
 
-            # 3. Extract Rules
-            extract_rules_from_text(doc_id, content)
+def make_citation(prefix, number, year=None, issuer=None):
+    """Builds a structured citation with its canonical key (see parse_citation), or None if incomplete."""
+    display, needs_year = CITATION_PREFIXES[prefix]
+    if needs_year and not (year and issuer):
+        return None
 
-    # 4. Resolve dependencies (link names to IDs)
-    database.resolve_dependencies()
+    number = str(int(number))
+    if needs_year:
+        # Supreme decrees and resolutions are numbered per year and issuer: 029-2021-PCM
+        issuer = issuer.upper()
+        number = number.zfill(3)
+        code = f"{number}-{year}-{issuer}"
+    else:
+        year = issuer = None
+        code = number
+
+    return {
+        "type": prefix,
+        "number": number,
+        "year": year,
+        "issuer": issuer,
+        "key": f"{prefix}-{code}",
+        "label": f"{display} N° {code}",
+    }
+
+def find_document_keys(filename, text):
+    """
+    Returns the citation keys that identify a document itself, taken from its filename
+    (LEY_PERU_31814_... -> LEY-31814, REGL_PCM_DS115_2025_... -> DS-115-2025-PCM) and from
+    citations opening its first lines ("# DECRETO SUPREMO Nº 115-2025-PCM").
+    """
+    keys = []
+
+    # Filename tokens: a type prefix, optionally fused with its number, then year and issuer.
+    # Only the leading tokens name the document; later ones are a free description.
+    tokens = os.path.splitext(filename)[0].upper().split("_")
+    for i, token in enumerate(tokens[:3]):
+        m = FILENAME_TYPE_PATTERN.fullmatch(token)
+        if not m:
+            continue
+        prefix, number = m.groups()
+        rest = tokens[i + 1:]
+        if not number:
+            number = next((t for t in rest[:2] if t.isdigit()), None)
+            if number is None:
+                continue
+            rest = rest[rest.index(number) + 1:]
+        year = rest[0] if rest and len(rest[0]) == 4 and rest[0].isdigit() else None
+        issuer = None
+        if year:
+            if i > 0 and tokens[i - 1].isalpha():
+                # REGL_PCM_DS115_2025: the issuer comes before the type
+                issuer = tokens[i - 1]
+            elif len(rest) > 1 and rest[1].isalpha():
+                issuer = rest[1]
+        citation = make_citation(prefix, number, year, issuer)
+        if citation:
+            keys.append(citation["key"])
+
+    # Header lines
+    header = [line for line in text[:2000].split("\n") if line.strip()][:3]
+    for line in header:
+        m = HEADER_CITATION_PATTERN.match(line)
+        citation = parse_citation(m) if m else None
+        if citation:
+            keys.append(citation["key"])
+
+    return list(dict.fromkeys(keys))
+
+def find_dependencies(text):
+    """Finds references to other legal docs in a single regex pass. Returns unique citations sorted by key."""
+    citations = {}
+    for match in CITATION_PATTERN.finditer(text):
+        citation = parse_citation(match)
+        if citation:
+            citations.setdefault(citation["key"], citation)
+    return [citations[key] for key in sorted(citations)]
 
+@timed
 def extract_dependencies_from_text(doc_id, text):
-    """Finds references to other legal docs using regex."""
-    found_refs = set()
-    for pattern in DEP_PATTERNS:
-        matches = re.findall(pattern, text, re.IGNORECASE)
-        for m in matches:
-            found_refs.add(m)
-    
-    for ref in found_refs:
-        database.add_dependency(doc_id, ref)
+    """Finds references to other legal docs and replaces the document's dependencies with them."""
+    doc = database.get_doc_by_id(doc_id)
+    keys = find_document_keys(doc[1], text) if doc else []
+    database.replace_dependencies(doc_id, _external_citations(find_dependencies(text), keys))
 
-def extract_rules_from_text(doc_id, text):
-    """Splits text into chunks/sentences and looks for rule keywords."""
-    # Simple splitting by newline or period (naive approach)
-    # Ideally use NLTK or Spacy, but sticking to stdlib for MVP
-    lines = text.split('\n')
-    
+def _external_citations(citations, keys):
+    """The citations not among keys: a document citing itself (e.g. in its own header) is not a dependency"""
+    return [cit for cit in citations if cit["key"] not in keys]
+
+def classify_rule(line):
+    """
+    Classifies a line in a single pass of the trigger regex. Returns (rule_type, (start, end) of
+    the trigger phrase in line), or None when no trigger appears as a whole word.
+    """
+    best = RULE_TRIGGER_PATTERN.search(line)
+    if best is None:
+        return None
+    rank = int(best.lastgroup[1:])
+    # A later trigger of a type with precedence wins (e.g. "debe ... no podrá")
+    for match in RULE_TRIGGER_PATTERN.finditer(line, best.end()) if rank else ():
+        if int(match.lastgroup[1:]) < rank:
+            best, rank = match, int(match.lastgroup[1:])
+            if rank == 0:
+                break
+    return RULE_TRIGGER_TYPES[rank], best.span()
+
+def _ends_with_abbreviation(text):
+    """Whether text ends with an abbreviation or an initial ("Art.", "R.M.") rather than a sentence"""
+    match = ABBREVIATION_PATTERN.search(text[-12:])
+    return bool(match) and (len(match.group(1)) == 1 or match.group(1).lower() in ABBREVIATIONS)
+
+def clause_segmenter(emit):
+    """
+    Push-style sentence/clause segmenter. Returns feed(line): feed it the lines of a text in
+    order (with their line endings, as read from a file) and it calls emit(text, start, end)
+    for every finished sentence or numbered clause, where start/end are character offsets in
+    the text and text has its wrapped lines joined by single spaces; feed(None) flushes the
+    last one. Clauses end at blank lines, section headers, sentence ends and lines opening a
+    new article, numbered clause or literal, so a soft line break never splits a sentence.
+    Only the pending clause is held in memory.
+    """
+    parts = []
+    start = end = pos = size = 0
+
+    def flush():
+        nonlocal size
+        if parts:
+            emit(" ".join(parts), start, end)
+            parts.clear()
+            size = 0
+
+    def add(piece, piece_start):
+        nonlocal start, end, size
+        if not parts:
+            start = piece_start
+        parts.append(piece)
+        end = piece_start + len(piece)
+        size += len(piece) + 1
+        if size >= MAX_CLAUSE_CHARS:
+            flush()
+
+    def feed(line):
+        nonlocal pos
+        if line is None:
+            flush()
+            return
+        line_start = pos
+        pos += len(line)
+        stripped = line.strip()
+        if not INDEX_TOKEN_PATTERN.search(stripped):  # Blank or a rule ("=====")
+            flush()
+            return
+        offset = line_start + len(line) - len(line.lstrip())
+
+        if is_section_header(stripped):
+            flush()
+            add(stripped, offset)
+            flush()
+            return
+        # A new clause, or a new sentence after one that ended with the previous line
+        if CLAUSE_START_PATTERN.match(stripped) or (
+                parts and parts[-1][-1] in ".!?" and stripped[0].isupper() and not _ends_with_abbreviation(parts[-1])):
+            flush()
+
+        piece_start = 0
+        for match in SENTENCE_END_PATTERN.finditer(stripped):
+            if _ends_with_abbreviation(stripped[piece_start:match.start() + 1]):
+                continue
+            add(stripped[piece_start:match.start() + 1], offset + piece_start)
+            flush()
+            piece_start = match.end()
+        add(stripped[piece_start:], offset + piece_start)
+
+    return feed
+
+def iter_clauses(lines):
+    """Yields (text, start, end) for every sentence or numbered clause of a stream of lines (see clause_segmenter)"""
+    finished = deque()
+    feed = clause_segmenter(lambda *clause: finished.append(clause))
     for line in lines:
-        line = line.strip()
-        if not line:
-            continue
-            
-        lower_line = line.lower()
-        
-        rule_type = None
-        if any(w in lower_line for w in PROHIBITION_KEYWORDS):
-            rule_type = "PROHIBITION"
-        elif any(w in lower_line for w in OBLIGATION_KEYWORDS):
-            rule_type = "OBLIGATION"
-            
-        if rule_type:
-            database.add_rule(doc_id, line, rule_type)
+        feed(line)
+        while finished:
+            yield finished.popleft()
+    feed(None)
+    yield from finished
+
+def iter_rules(lines):
+    """
+    Looks for rule keywords sentence by sentence, yielding (rule_text, rule_type). Works over any
+    stream of lines; an obligation wrapped over several lines comes out as one rule.
+    """
+    for text, _, _ in iter_clauses(lines):
+        found = classify_rule(text)
+        if found:
+            yield text, found[0]
+
+def find_rules(text):
+    """Splits text into sentences and clauses and looks for rule keywords. Returns a list of (rule_text, rule_type)."""
+    return list(iter_rules(io.StringIO(text)))
+
+@timed
+def extract_rules_from_text(doc_id, text):
+    """Extracts the rules of a document, replacing its previous rule set so rescans never duplicate rules."""
+    database.replace_rules(doc_id, find_rules(text))
 
 def check_compliance(child_content, parent_rule_text):
     """
     Checks if a rule from the parent exists in the child content.
     For this MVP, we perform a 'fuzzy' keyword match.
     We take the 'core' of the rule (excluding stopwords could be better)
-    and see if a significant portion exists in the child.
+    and see if a significant portion exists in one passage of the child.
     
     Alternative Naive approach:
     Just check if ANY of the significant words (nouns/verbs) from the rule appear in the child.
     """
-    
-    rule_words = set(parent_rule_text.lower().split())
-    keywords = rule_words - STOP_WORDS
-    
-    if not keywords:
-        return "UNKNOWN" # Rule was too short or only stopwords
-    
-    hits = 0
-    child_lower = child_content.lower()
-    
-    for kw in keywords:
-        if kw in child_lower:
-            hits += 1
-            
-    # If a significant chunk of keywords are found, we assume "adderssed"
-    ratio = hits / len(keywords)
-    
-    if ratio > 0.6:
-        return "MATCH" # Green
-    elif ratio > 0.3:
-        return "PARTIAL" # Yellow
-    else:
-        return "MISSING" # Red
+    return check_compliance_batch(child_content, [parent_rule_text])[0]
+
+@timed
+def check_compliance_batch(child_content, rule_texts):
+    """
+    Checks many parent rules against one child text that is not in the DB, returning one
+    verdict per rule. The text is split into passages (its sections) and indexed in memory
+    once; the verdicts are the same as match_rules_in_document gives for a stored document.
+    """
+    bounds = iter_section_bounds(io.StringIO(child_content))
+    index = database.index_passages((position, child_content[start:end]) for position, (_, start, end) in enumerate(bounds))
+    return [status for status, _ in match_rules(rule_texts, lambda keyword: index.get(keyword, ()))]
+
+@lru_cache(maxsize=4096)
+def rule_keywords(rule_text):
+    """The significant words of a rule (no stop words), as terms of the full-text index"""
+    return frozenset(term for term in database.tokenize(rule_text) if term not in STOP_TERMS)
+
+@timed
+def match_rules(rule_texts, postings):
+    """
+    Scores rules against the passages of one child document through an inverted index:
+    postings(keyword) returns the positions of the passages containing the keyword, so the
+    work is proportional to the rules' postings and not to the document length.
+    Returns one (status, position of the best passage or None) per rule. A rule is a MATCH
+    when more than 60% of its keywords appear together in one passage, so words scattered
+    over the whole document no longer count as compliance.
+    """
+    results = []
+    for rule_text in rule_texts:
+        keywords = rule_keywords(rule_text)
+        if not keywords:
+            results.append(("UNKNOWN", None)) # Rule was too short or only stopwords
+            continue
+
+        hits = Counter()
+        for kw in keywords:
+            hits.update(postings(kw))
+        if not hits:
+            results.append(("MISSING", None))
+            continue
+        # Passage with most keywords; the earliest one on ties
+        position, found = min(hits.items(), key=lambda item: (-item[1], item[0]))
+
+        # If a significant chunk of keywords are found, we assume "adderssed"
+        ratio = found / len(keywords)
+        
+        if ratio > 0.6:
+            results.append(("MATCH", position)) # Green
+        elif ratio > 0.3:
+            results.append(("PARTIAL", position)) # Yellow
+        else:
+            results.append(("MISSING", position)) # Red
+
+    return results
+
+def section_postings(doc_id):
+    """
+    Postings lookup over the sections of a stored document (see match_rules): one full-text
+    query per distinct keyword, remembered for the next rules (and parents) that use it
+    """
+    found = {}
+    def postings(keyword):
+        if keyword not in found:
+            found[keyword] = database.get_section_postings(doc_id, keyword)
+        return found[keyword]
+    return postings
+
+@timed
+def match_rules_in_document(doc_id, rule_texts, postings=None):
+    """
+    Checks rules against a stored child document using its sections as passages, looked up
+    in the full-text index of the sections (see section_postings).
+    Returns one (status, evidence) per rule, where evidence is the (start, end) character
+    offsets of the best-matching passage in the child, or None.
+    """
+    offsets = {position: (start, end) for position, _, start, end, _ in get_document_structure(doc_id)[1]}
+    results = match_rules(rule_texts, postings or section_postings(doc_id))
+    return [(status, offsets.get(position)) for status, position in results]
+
+@timed
+def audit_against_parents(child_doc_id, parents, pending_cache=None):
+    """
+    Checks the rules of every parent against a child document.
+    Returns [(parent_id, parent_filename, [(rule_text, rule_type, status, evidence), ...]), ...],
+    where evidence is the (start, end) offsets of the child passage that best matches the rule.
+    Verdicts are cached per (child hash, parent rule set hash, COMPLIANCE_VERSION), so
+    re-opening a document only costs one SELECT until either document changes.
+    With pending_cache (a list), new cache entries are appended to it instead of written,
+    so batch workers stay read-only and one process does all the writes.
+    Returns [] when child_doc_id is not a known document.
+    """
+    child_hash = database.get_doc_hash(child_doc_id)
+    if child_hash is None:
+        content = database.get_doc_content(child_doc_id)
+        if content is None:
+            return []
+        child_hash = hashlib.sha256(content.encode("utf-8")).hexdigest()
+    cached = database.get_audit_cache(child_hash, COMPLIANCE_VERSION)
+    postings = section_postings(child_doc_id)  # Shared by all the parents
+
+    report = []
+    for p_id, p_filename in parents:
+        rules = database.get_rules_for_doc(p_id)
+        ruleset_hash = hashlib.sha256(repr(rules).encode("utf-8")).hexdigest()
+        results = cached.get(ruleset_hash)
+        if results is None:
+            AUDIT_CACHE_STATS["misses"] += 1
+            results = match_rules_in_document(child_doc_id, [rule_text for rule_text, _ in rules], postings)
+            entry = (child_doc_id, p_id, child_hash, ruleset_hash, COMPLIANCE_VERSION, results)
+            if pending_cache is None:
+                database.save_audit_cache(*entry)
+            else:
+                pending_cache.append(entry)
+        else:
+            AUDIT_CACHE_STATS["hits"] += 1
+        report.append((p_id, p_filename, [(text, rtype, status, tuple(evidence) if evidence else None)
+                                          for (text, rtype), (status, evidence) in zip(rules, results)]))
+    return report
+
+def to_fts_query(text, match_all=False):
+    """
+    Turns free text into an FTS5 query: its significant words, each quoted (so user input
+    can never be FTS5 syntax), joined with AND or OR. Returns None when no word is left.
+    With OR, BM25 still ranks passages that contain more of the words first.
+    """
+    words = dict.fromkeys(w for w in WORD_PATTERN.findall(text.lower()) if w not in STOP_WORDS)
+    if not words:
+        return None
+    return (" AND " if match_all else " OR ").join(f'"{w}"' for w in words)
+
+@timed
+def search(text, limit=10):
+    """
+    Searches the whole corpus for passages (sections) containing all the words of text.
+    Returns [(doc_id, filename, position, title, start, end, snippet, score)], best first.
+    """
+    query = to_fts_query(text, match_all=True)
+    return database.search_sections(query, limit=limit) if query else []
 
-def generate_summary(text, num_sentences=3):
-    """Generates a simple extractive summary based on word frequency."""
+@timed
+def find_rule_passages(rule_text, doc_id=None, limit=3):
+    """
+    Returns the passages (sections) that best match a rule, optionally within one child
+    document, ranked by BM25 over the full-text index instead of scanning the content.
+    Same tuples as search().
+    """
+    query = to_fts_query(rule_text)
+    return database.search_sections(query, doc_id=doc_id, limit=limit) if query else []
+
+def word_frequencies(text):
+    """Counts the non stop-word tokens of a text (the frequency table used by generate_summary)."""
+    word_freq = Counter(WORD_PATTERN.findall(text.lower()))
+    for word in STOP_WORDS:
+        del word_freq[word]
+    return word_freq
+
+@timed
+def generate_summary(text, num_sentences=3, word_freq=None):
+    """
+    Generates a simple extractive summary based on word frequency.
+    Each sentence is tokenized once (the frequency table is counted from those same tokens)
+    and the top sentences are picked with a heap. word_freq may be a precomputed table (see
+    word_frequencies), e.g. the whole document's when summarizing one of its sections.
+    """
     if not text:
         return ""
         
-    sentences = re.split(r'(?<=[.!?])\s+', text)
+    sentences = SENTENCE_SPLIT_PATTERN.split(text)
     if len(sentences) <= num_sentences:
         return text
     
+    # Lowercasing never adds whitespace or punctuation, so both splits line up
+    sentence_tokens = [WORD_PATTERN.findall(s) for s in SENTENCE_SPLIT_PATTERN.split(text.lower())]
+    
     # Calculate word frequencies
-    word_freq = {}
-    tokens = re.findall(r'\w+', text.lower())
-    for word in tokens:
-        if word not in STOP_WORDS:
-            word_freq[word] = word_freq.get(word, 0) + 1
+    if word_freq is None:
+        word_freq = Counter(chain.from_iterable(sentence_tokens))
+        for word in STOP_WORDS:
+            del word_freq[word]
             
     # Score sentences
-    scores = []
-    for i, sentence in enumerate(sentences):
-        score = 0
-        s_tokens = re.findall(r'\w+', sentence.lower())
-        if not s_tokens:
-            continue
-        for word in s_tokens:
-            if word in word_freq:
-                score += word_freq[word]
-        # Normalize by length to avoid bias towards long sentences
-        scores.append((score / len(s_tokens), i, sentence))
+    # Normalize by length to avoid bias towards long sentences
+    scores = [(sum(map(word_freq.get, tokens, repeat(0))) / len(tokens), i)
+              for i, tokens in enumerate(sentence_tokens) if tokens]
         
     # Get top N sentences, preserve order
-    scores.sort(key=lambda x: x[0], reverse=True)
-    top_sentences = sorted(scores[:num_sentences], key=lambda x: x[1])
+    top_sentences = sorted(heapq.nlargest(num_sentences, scores, key=lambda x: x[0]), key=lambda x: x[1])
     
-    return " ".join([s[2] for s in top_sentences])
+    return " ".join(sentences[i] for _, i in top_sentences)
+
+def is_section_header(stripped):
+    """Whether a (stripped, non-empty) line looks like a section title."""
+    # Check standard headers
+    if SECTION_HEADER_PATTERN.match(stripped):
+        return True
+    # Check uppercase lines that are short enough to be titles, but not too short
+    return stripped.isupper() and len(stripped) > 5 and len(stripped) < 100
+
+def iter_section_bounds(lines):
+    """
+    Splits a document into sections ensuring min 1000 chars per section where possible.
+    Takes the document as a stream of lines (with their line endings, as read from a file)
+    and yields (title, start, end) character offsets, so it never needs the whole text.
+    """
+    title = "Introducción / Preámbulo"
+    section_start = 0  # Offset of the first line of the current section
+    pos = 0
+    previous = None  # Finished section, held back in case the last one must be merged into it
+
+    for line in lines:
+        line_start = pos
+        pos += len(line)
+        stripped = line.strip()
+        if not stripped or not is_section_header(stripped):
+            continue
+
+        # Check if current section is big enough (its text ends before this line's newline)
+        section_end = max(line_start - 1, section_start)
+        # User preference: "minimo 1000 caracteres"
+        # Strategy: If current buffer < 1000, DO NOT split, treat this header as subtitle
+        # (it simply stays in the current section's text).
+        if section_end - section_start >= 1000 or previous is None:
+            if previous:
+                yield previous
+            previous = (title, section_start, section_end)
+            title = stripped
+            section_start = pos # Start fresh after the header line
+
+    # Flush last section
+    if previous and pos - section_start < 1000:
+        # Merge with last (its text now runs to the end, including the last header line)
+        yield previous[0], previous[1], pos
+    else:
+        if previous:
+            yield previous
+        yield title, section_start, pos
 
+@timed
 def analyze_document_structure(text):
     """
     Analyzes document to return:
     - General Summary
     - Sections (Header, Summary, Content) ensuring min 1000 chars per section where possible
+    Each section also carries its "start"/"end" character offsets in text (content == text[start:end]),
+    which is what gets stored at ingest time.
     """
     # 1. Generate General Summary (from first 3000 chars approx)
     general_summary = generate_summary(text[:5000], num_sentences=4)
+    # Section summaries score sentences with the whole document's word frequencies
+    doc_freq = word_frequencies(text)
     
     # 2. Split into sections
-    # Regex for potential headers: Uppercase lines or specific keywords
-    # We look for lines that look like titles
-    lines = text.split('\n')
     sections = []
-    current_section_title = "Introducción / Preámbulo"
-    current_section_lines = []
-    
-    header_pattern = re.compile(r'^(TÍTULO|TITULO|CAPÍTULO|CAPITULO|SECCIÓN|SECCION|ARTÍCULO|ARTICULO)\s', re.IGNORECASE)
-    
-    for line in lines:
-        stripped = line.strip()
-        if not stripped:
-            current_section_lines.append(line)
-            continue
-            
-        is_header = False
-        
-        # Check standard headers
-        if header_pattern.match(stripped):
-            is_header = True
-        # Check uppercase lines that are short enough to be titles, but not too short
-        elif stripped.isupper() and len(stripped) > 5 and len(stripped) < 100:
-            is_header = True
-            
-        if is_header:
-            # Check if current section is big enough
-            current_text = "\n".join(current_section_lines)
-            if len(current_text) < 1000 and sections:
-                # Too small, append to previous section if exists, OR just keep accumulating
-                # User preference: "minimo 1000 caracteres"
-                # If we split here, the *previous* section is finished. 
-                # Let's check the size of the *accumulated* text.
-                # Actually, the logic usually is: convert current buffer to section, start new.
-                # But if current buffer is small, maybe we shouldn't split?
-                # However, headers are semantic. Merging headers might be confusing.
-                # Compromise: We always respect headers, but if a section is tiny, we might flag it or merge it 
-                # visually later? No, user explicitly asked for 1000 chars min.
-                # Strategy: If current buffer < 1000, DO NOT split, treat this header as subtitle.
-                if len(current_text) >= 1000 or not sections:
-                     # Save current section
-                     sections.append({
-                         "title": current_section_title,
-                         "content": current_text,
-                         "summary": generate_summary(current_text)
-                     })
-                     current_section_title = stripped
-                     current_section_lines = []
-                else:
-                    # Continue in same section, maybe append header as text
-                    current_section_lines.append(line)
-            else:
-                 # Standard split
-                 sections.append({
-                     "title": current_section_title,
-                     "content": current_text,
-                     "summary": generate_summary(current_text)
-                 })
-                 current_section_title = stripped
-                 current_section_lines = [] # Start fresh
-        else:
-            current_section_lines.append(line)
-            
-    # Flush last section
-    final_text = "\n".join(current_section_lines)
-    if sections and len(final_text) < 1000:
-        # Merge with last
-        sections[-1]["content"] += "\n" + final_text
-        # Re-summarize last section
-        sections[-1]["summary"] = generate_summary(sections[-1]["content"])
-    else:
+    for title, start, end in iter_section_bounds(io.StringIO(text)):
+        content = text[start:end]
         sections.append({
-            "title": current_section_title,
-            "content": final_text,
-            "summary": generate_summary(final_text)
+            "title": title,
+            "start": start,
+            "end": end,
+            "content": content,
+            "summary": generate_summary(content, word_freq=doc_freq)
         })
         
     return {
         "general_summary": general_summary,
         "sections": sections
     }
+
+@timed
+def get_document_structure(doc_id):
+    """
+    Returns (general_summary, sections) as precomputed at ingest time, where sections are
+    (position, title, start, end, summary) tuples; bodies are loaded with database.get_section_content.
+    Documents scanned before structures were stored are analyzed and stored on first access.
+    """
+    general_summary = database.get_doc_summary(doc_id)
+    if general_summary is None:
+        struct = analyze_document_structure(database.get_doc_content(doc_id))
+        database.replace_sections(doc_id, struct["general_summary"], struct["sections"])
+        general_summary = struct["general_summary"]
+    return general_summary, database.get_sections(doc_id)
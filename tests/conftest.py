@@ -0,0 +1,16 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import database
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """A new, migrated database in a temporary directory, on a connection of its own"""
+    database.close_connection()
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "test.db"))
+    database.init_db()
+    yield database.get_connection()
+    database.close_connection()
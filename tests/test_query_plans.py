@@ -0,0 +1,13 @@
+"""Query plan regression tests: no hot query may scan a whole table (see database.check_query_plans)"""
+import database
+
+def test_hot_queries_use_indexes(db):
+    # db is a new database on a new connection, so no cached statement hides a changed plan
+    assert database.check_query_plans() == []
+
+def test_check_query_plans_catches_scans(db, monkeypatch):
+    monkeypatch.setattr(database, "HOT_QUERIES", {
+        "aliased": "SELECT d.id FROM docs d WHERE d.content LIKE ?",
+        "cte": "WITH r(x) AS (SELECT 1 UNION SELECT x + 1 FROM r WHERE x < 3) SELECT x FROM r",
+    })
+    assert [name for name, _ in database.check_query_plans()] == ["aliased"]
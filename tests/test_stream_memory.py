@@ -0,0 +1,45 @@
+"""Memory regression test of the streaming ingest path (see benchmarks/bench_stream_memory.py)"""
+import os
+import tracemalloc
+
+import processor
+
+# Peak memory growth tolerated per MB of file: anything held per line, rule or section shows up here
+MAX_GROWTH_PER_MB = 0.05
+
+BUNDLED_DOCS_DIR = processor.DOCS_DIR
+
+def _write_file(path, size_mb):
+    """A file of size_mb MB made of the bundled documentos/ texts, repeated"""
+    texts = []
+    for filename in sorted(os.listdir(BUNDLED_DOCS_DIR)):
+        if filename.endswith(".txt"):
+            with open(os.path.join(BUNDLED_DOCS_DIR, filename), "r", encoding="utf-8", errors="ignore") as f:
+                texts.append(f.read())
+    corpus = "\n".join(texts)
+    written = 0
+    with open(path, "w", encoding="utf-8") as f:
+        while written < size_mb * 1024 * 1024:
+            f.write(corpus)
+            written += len(corpus.encode("utf-8"))
+
+def _peak_ingesting(docs_dir, size_mb):
+    filename = f"CONSOLIDADO_{size_mb}MB.txt"
+    _write_file(os.path.join(docs_dir, filename), size_mb)
+    file_stat = os.stat(os.path.join(docs_dir, filename))
+    tracemalloc.start()
+    try:
+        assert processor._ingest_streaming(filename, file_stat, None) == "added"
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def test_streaming_peak_memory_is_flat(db, tmp_path, monkeypatch):
+    docs_dir = tmp_path / "documentos"
+    docs_dir.mkdir()
+    monkeypatch.setattr(processor, "DOCS_DIR", str(docs_dir))
+    peak_small = _peak_ingesting(str(docs_dir), 2)
+    peak_large = _peak_ingesting(str(docs_dir), 8)
+    growth = (peak_large - peak_small) / (8 - 2) / 1024 / 1024
+    assert growth <= MAX_GROWTH_PER_MB, (
+        f"peak memory grows {growth:.3f} MB per MB of file ({peak_small / 2**20:.1f} MB -> {peak_large / 2**20:.1f} MB)")